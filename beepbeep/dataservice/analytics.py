@@ -0,0 +1,72 @@
+import numpy as np
+from sqlalchemy import select
+from beepbeep.dataservice.cache import MemoryCache
+from beepbeep.dataservice.database import db, Run
+
+
+METRICS = ('average_speed', 'average_heartrate', 'distance')
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+_cache = MemoryCache(size=256, ttl=3600)
+
+
+def init_analytics(app):
+    global _cache
+    _cache = MemoryCache(size=int(app.config.get('ANALYTICS_CACHE_SIZE', 256)),
+                         ttl=int(app.config.get('ANALYTICS_CACHE_TTL', 3600)))
+
+
+def load_columns(user_id):
+    """Returns the metrics of all the runs of a user, oldest first, as a dict of float arrays.
+
+    Missing values are NaN, as the heartrates that are not positive.
+    """
+    columns = [getattr(Run, metric) for metric in METRICS]
+    stmt = select(columns).where(Run.runner_id == user_id).order_by(Run.start_date, Run.id)
+    rows = db.session.execute(stmt).fetchall()
+    data = np.array(rows, dtype=float).reshape(len(rows), len(METRICS))
+    res = {metric: data[:, i] for i, metric in enumerate(METRICS)}
+    heartrate = res['average_heartrate']
+    heartrate[heartrate <= 0] = np.nan
+    return res
+
+
+def rolling_average(values, window):
+    if len(values) < window:
+        return np.empty(0)
+    sums = np.cumsum(np.concatenate(([0.0], values)))
+    return (sums[window:] - sums[:-window]) / window
+
+
+def describe(values, percentiles=DEFAULT_PERCENTILES, bins=10, window=7):
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return {'count': 0, 'mean': None, 'min': None, 'max': None,
+                'percentiles': {'%g' % p: None for p in percentiles},
+                'histogram': {'counts': [], 'edges': []},
+                'rolling_average': []}
+
+    counts, edges = np.histogram(values, bins=bins)
+    return {'count': int(values.size),
+            'mean': float(values.mean()),
+            'min': float(values.min()),
+            'max': float(values.max()),
+            'percentiles': dict(zip(('%g' % p for p in percentiles),
+                                    np.percentile(values, percentiles).tolist())),
+            'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()},
+            'rolling_average': rolling_average(values, window).tolist()}
+
+
+def user_analytics(user_id, version, percentiles=DEFAULT_PERCENTILES, bins=10, window=7):
+    """Returns the distributions of the metrics of a user's runs.
+
+    The results are cached by user `version`, so they are computed again
+    only once new runs are added.
+    """
+    key = (user_id, version, tuple(percentiles), bins, window)
+    res = _cache.get(key)
+    if res is None:
+        columns = load_columns(user_id)
+        res = {metric: describe(columns[metric], percentiles, bins, window) for metric in METRICS}
+        _cache.set(key, res)
+    return res
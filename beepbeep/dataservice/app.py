@@ -1,14 +1,22 @@
 import os
+import time
 from werkzeug.exceptions import HTTPException
 from flakon import create_app as _create_app
 from flakon.util import error_handling
 from flask import request, abort, g
 from flask_cors import CORS
 
-import jwt
-
 from .views import blueprints
+from .views.swagger import api
 from .database import db
+from .analytics import init_analytics
+from .cache import cache
+from .compression import init_compression
+from .encoding import set_encoder
+from .metrics import add_gauge, init_metrics, observe
+from .remote import http
+from .replicas import replicas
+from .tokens import TokenCache, load_public_key, decode_token
 
 
 _HERE = os.path.dirname(__file__)
@@ -22,19 +30,47 @@ def create_app(settings=None):
 
     app = _create_app(blueprints=blueprints, settings=settings)
 
-    with open(app.config['pub_key']) as f:
-        app.config['pub_key'] = f.read()
-
+    app.config['pub_key'] = load_public_key(app.config['pub_key'])
+    app.token_cache = TokenCache(size=int(app.config.get('JWT_CACHE_SIZE', 1024)),
+                                 ttl=int(app.config.get('JWT_CACHE_TTL', 300)))
+
+    # first, so that the other hooks are measured as well
+    init_metrics(app, api.ops)
+    cache.init_app(app)
+    set_encoder(str(app.config.get('JSON_ENCODER', 'auto')))
+    init_compression(app)
+    init_analytics(app)
+    http.init_app(app)
+    replicas.init_app(app)
     CORS(app)
+    _add_gauges(app)
 
     @app.before_request
     def before_req():
+        if request.endpoint == 'metrics.render_metrics':
+            return
         if app.config.get('NEED_TOKEN', True):
             authenticate(app, request)
 
     return app
 
 
+def _add_gauges(app):
+    def caches():
+        res = {}
+        for name, backend in (('token', app.token_cache), ('response', cache.backend)):
+            if backend is not None:
+                for stat, value in backend.stats().items():
+                    res[name, stat] = value
+        return res
+
+    def http_pool():
+        return {(stat,): value for stat, value in http.stats().items()}
+
+    add_gauge('beepbeep_cache', 'Statistics of the token and response caches', ('cache', 'stat'), caches)
+    add_gauge('beepbeep_http_pool', 'Statistics of the outbound HTTP pool', ('stat',), http_pool)
+
+
 def _400(desc):  # pragma: no cover
     exc = HTTPException()
     exc.code = 400
@@ -55,11 +91,14 @@ def authenticate(app, request):  # pragma: no cover
         return abort(401)
 
     pub_key = app.config['pub_key']
+    start = time.perf_counter()
     try:
         token = key[1]
-        token = jwt.decode(token, pub_key, audience='beepbeep.io')
+        token = decode_token(token, pub_key, app.token_cache)
     except Exception as e:
         return abort(401)
+    finally:
+        observe('auth', time.perf_counter() - start)
 
     # we have the token ~ copied into the globals
     g.jwt_token = token
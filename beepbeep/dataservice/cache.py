@@ -0,0 +1,153 @@
+import math
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class MemoryCache(object):
+    """Thread safe in-process LRU cache whose entries expire after `ttl` seconds."""
+    def __init__(self, size=1024, ttl=300, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if self.size <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value, self._clock() + ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'max_size': self.size}
+
+
+class RedisCache(object):
+    """Cache backend storing the entries in a Redis compatible server."""
+    def __init__(self, url, ttl=300, prefix='beepbeep.dataservice:'):
+        import redis
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._prefix = prefix
+        self._redis = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        value = self._redis.get(self._prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value.decode('utf8')
+
+    def set(self, key, value, ttl=None):
+        # Redis only takes whole seconds
+        ttl = int(math.ceil(ttl or self.ttl))
+        if ttl > 0:
+            self._redis.setex(self._prefix + key, ttl, value)
+
+    def delete(self, *keys):
+        if keys:
+            self._redis.delete(*[self._prefix + key for key in keys])
+
+    def clear(self):
+        for key in self._redis.scan_iter(self._prefix + '*'):
+            self._redis.delete(key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class Cache(object):
+    """Read-through cache of the serialized payloads of the API.
+
+    The backend is chosen by `init_app` from the CACHE_* settings; until
+    then, or when CACHE_BACKEND is `none`, every lookup is a miss.
+    """
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        kind = str(app.config.get('CACHE_BACKEND', 'memory')).lower()
+        ttl = int(app.config.get('CACHE_TTL', 60))
+        if kind == 'memory':
+            self.backend = MemoryCache(size=int(app.config.get('CACHE_SIZE', 4096)), ttl=ttl)
+        elif kind == 'redis':
+            self.backend = RedisCache(app.config['CACHE_REDIS_URL'], ttl=ttl)
+        elif kind == 'none':
+            self.backend = None
+        else:
+            raise ValueError('Unknown CACHE_BACKEND ' + kind)
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    def delete(self, *keys):
+        if self.backend is not None:
+            self.backend.delete(*keys)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def invalidate_user(self, *user_ids):
+        keys = []
+        for user_id in user_ids:
+            keys.extend(user_keys(user_id))
+        self.delete(*keys)
+
+
+def user_key(user_id, secure=False):
+    return 'user:%d:%s' % (int(user_id), 'secure' if secure else 'public')
+
+
+def average_key(user_id):
+    return 'average:%d' % int(user_id)
+
+
+def version_key(user_id):
+    return 'version:%d' % int(user_id)
+
+
+def user_keys(user_id):
+    return [user_key(user_id), user_key(user_id, True), average_key(user_id), version_key(user_id)]
+
+
+cache = Cache()
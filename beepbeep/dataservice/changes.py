@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select, literal, exists, and_
+from beepbeep.dataservice.database import db, Run, Change
+from beepbeep.dataservice.queries import chunks
+
+
+def log_change(entity, entity_id, user_id, op):
+    db.session.add(Change(entity=entity, entity_id=entity_id, user_id=user_id, op=op))
+
+
+def _log_runs(condition, op):
+    table = Change.__table__
+    runs = select([literal('run'), Run.id, Run.runner_id, literal(op), literal(datetime.utcnow())])
+    runs = runs.where(condition)
+    db.session.execute(table.insert().from_select(
+        ['entity', 'entity_id', 'user_id', 'op', 'created_at'], runs))
+
+
+def log_run_inserts(run_ids):
+    """Logs the insertion of the runs with the given ids."""
+    for chunk in chunks(run_ids):
+        _log_runs(Run.id.in_(chunk), 'insert')
+
+
+def log_run_deletes(run_ids):
+    """Logs the deletion of the runs with the given ids, which must still be stored."""
+    for chunk in chunks(run_ids):
+        _log_runs(Run.id.in_(chunk), 'delete')
+
+
+def log_new_runs(strava_ids):
+    """Logs the insertion of the runs with the given strava ids that are not logged yet.
+
+    For the batches where `ingest_runs` can't tell which runs it added:
+    `strava_ids` must be the ones that were not stored before the batch.
+    """
+    logged = exists().where(and_(Change.entity == 'run', Change.entity_id == Run.id,
+                                 Change.op == 'insert'))
+    for chunk in chunks(strava_ids):
+        _log_runs(and_(Run.strava_id.in_(chunk), ~logged), 'insert')
+
+
+def log_user_delete(user_id):
+    """Logs the deletion of a user along with all its runs."""
+    _log_runs(Run.runner_id == user_id, 'delete')
+    log_change('user', user_id, user_id, 'delete')
+
+
+def visibility_lag(config):
+    """Returns the CHANGES_VISIBILITY_LAG setting, in seconds.
+
+    With `auto` it's 0 on SQLite, which runs one write transaction at a
+    time, and 5 seconds on the other databases.
+    """
+    lag = str(config.get('CHANGES_VISIBILITY_LAG', 'auto')).lower()
+    if lag == 'auto':
+        return 0 if db.session.get_bind().dialect.name == 'sqlite' else 5
+    return float(lag)
+
+
+def get_changes(since=0, limit=100, lag=0):
+    """Returns the changes with a sequence number greater than `since`, oldest first.
+
+    The sequence numbers are given when the changes are written, not when
+    they are committed: on a database running concurrent transactions a
+    change can become visible after another one with a greater number has
+    been read, and the readers would skip it. The changes are returned
+    only `lag` seconds after they are written, enough for their
+    transaction to be committed.
+    """
+    q = db.session.query(Change).filter(Change.seq > since)
+    if lag > 0:
+        q = q.filter(Change.created_at <= datetime.utcnow() - timedelta(seconds=lag))
+    return q.order_by(Change.seq).limit(limit)
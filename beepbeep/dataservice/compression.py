@@ -0,0 +1,76 @@
+import zlib
+from flask import request
+
+
+CODINGS = ('gzip', 'deflate')
+_COMPRESSIBLE = ('application/json', 'text/plain', 'text/html')
+
+
+def _compressor(coding, level):
+    if coding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level)
+
+
+def _compress_stream(response, coding, level):
+    chunks = response.iter_encoded()
+    inner = response.response
+
+    def generate():
+        compressor = _compressor(coding, level)
+        try:
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(inner, 'close'):
+                inner.close()
+
+    return generate()
+
+
+def compress_response(response, min_size=1024, level=6):
+    """Compresses `response` with the best coding accepted by the client.
+
+    Buffered responses are compressed only when bigger than `min_size`
+    bytes, streamed ones are always compressed chunk by chunk.
+    """
+    if (response.status_code != 200 or response.direct_passthrough or
+            'Content-Encoding' in response.headers or
+            response.mimetype not in _COMPRESSIBLE):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    coding = request.accept_encodings.best_match(CODINGS)
+    if coding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response, coding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        compressor = _compressor(coding, level)
+        response.set_data(compressor.compress(data) + compressor.flush())
+
+    response.headers['Content-Encoding'] = coding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        # each coding is a different representation
+        response.set_etag('%s-%s' % (etag, coding), weak)
+    return response
+
+
+def init_compression(app):
+    if not app.config.get('COMPRESSION', True):
+        return
+    min_size = int(app.config.get('COMPRESSION_MIN_SIZE', 1024))
+    level = int(app.config.get('COMPRESSION_LEVEL', 6))
+
+    @app.after_request
+    def compress(response):
+        return compress_response(response, min_size, level)
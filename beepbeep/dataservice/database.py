@@ -1,13 +1,16 @@
 # encoding: utf8
+import logging
 import os
 from datetime import datetime
-from decimal import Decimal
+from functools import lru_cache
 from sqlalchemy.orm import relationship
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Enum
+from sqlalchemy import Enum, func, inspect
+from sqlalchemy.schema import CreateColumn
 import enum
+from .engine import ProfiledSQLAlchemy
 
-db = SQLAlchemy()
+db = ProfiledSQLAlchemy()
+logger = logging.getLogger(__name__)
 
 class ReportPeriodicity(enum.Enum):
     No     = 'No'
@@ -41,6 +44,11 @@ class ReportPeriodicity(enum.Enum):
 
 class User(db.Model):
     __tablename__ = 'user'
+    # the filters of the listings, ordered by id for the keyset pagination
+    __table_args__ = (
+        db.Index('ix_user_report_periodicity_id', 'report_periodicity', 'id'),
+        db.Index('ix_user_is_active_id', 'is_active', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     email = db.Column(db.Unicode(128), nullable=False)
     firstname = db.Column(db.Unicode(128))
@@ -56,22 +64,38 @@ class User(db.Model):
     total_speed = db.Column(db.Float)
     total_runs = db.Column(db.Integer)
     report_periodicity = db.Column(Enum(ReportPeriodicity), default=ReportPeriodicity.No)
+    # bumped every time the user or its runs change, used for the ETags
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_anonymous = False
 
     run = relationship('Run', cascade='delete')
+    stats = relationship('RunStats', cascade='delete')
 
-    def to_json(self, secure=False):
-        res = {}
-        for attr in ('id', 'email', 'firstname', 'lastname', 'age', 'weight',
-                     'max_hr', 'rest_hr', 'vo2max'):
-            value = getattr(self, attr)
-            if isinstance(value, Decimal):
-                value = float(value)
-            res[attr] = value
-            res['report_periodicity'] = ReportPeriodicity.to_json(self.report_periodicity)
+    JSON_FIELDS = ('id', 'email', 'firstname', 'lastname', 'age', 'weight',
+                   'max_hr', 'rest_hr', 'vo2max', 'report_periodicity')
+    SECURE_JSON_FIELDS = JSON_FIELDS + ('strava_token',)
+
+    @classmethod
+    def json_columns(cls, secure=False):
+        fields = cls.SECURE_JSON_FIELDS if secure else cls.JSON_FIELDS
+        return [getattr(cls, attr) for attr in fields]
+
+    @staticmethod
+    def row_to_json(row, secure=False):
         if secure:
-            res['strava_token'] = self.strava_token
-        return res
+            return _secure_user_row_to_json(row)
+        return _user_row_to_json(row)
+
+    @classmethod
+    def projection(cls, fields):
+        """Returns the columns of `fields` and the function turning their rows into dicts."""
+        fields = tuple(fields)
+        return [getattr(cls, attr) for attr in fields], _user_projection(fields)
+
+    def to_json(self, secure=False):
+        fields = User.SECURE_JSON_FIELDS if secure else User.JSON_FIELDS
+        return User.row_to_json([getattr(self, attr) for attr in fields], secure)
 
     @staticmethod
     def from_json(schema):
@@ -99,6 +123,10 @@ class User(db.Model):
 
 class Run(db.Model):
     __tablename__ = 'run'
+    __table_args__ = (
+        db.Index('ix_run_runner_start_date_id', 'runner_id', 'start_date', 'id'),
+        db.Index('ix_run_strava_id', 'strava_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.Unicode(128))
     description = db.Column(db.Unicode(512))
@@ -112,40 +140,45 @@ class Run(db.Model):
     runner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     runner = relationship('User', foreign_keys='Run.runner_id')
 
+    JSON_FIELDS = ('id', 'strava_id', 'distance', 'start_date',
+                   'elapsed_time', 'average_speed', 'average_heartrate',
+                   'total_elevation_gain', 'runner_id', 'title',
+                   'description')
+
+    @classmethod
+    def json_columns(cls):
+        return [getattr(cls, attr) for attr in cls.JSON_FIELDS]
+
+    @staticmethod
+    def row_to_json(row):
+        return _run_row_to_json(row)
+
     def to_json(self):
-        res = {}
-        for attr in ('id', 'strava_id', 'distance', 'start_date',
-                     'elapsed_time', 'average_speed', 'average_heartrate',
-                     'total_elevation_gain', 'runner_id', 'title',
-                     'description'):
-            value = getattr(self, attr)
-            if isinstance(value, datetime):
-                value = value.timestamp()
-            res[attr] = value
-        return res
+        return Run.row_to_json([getattr(self, attr) for attr in Run.JSON_FIELDS])
 
     @staticmethod
-    def from_json(schema, runner_id=None):
-        r = Run()
+    def row_from_json(schema, runner_id=None):
+        row = {}
         for attr in ('title', 'description', 'strava_id', 'distance', 'elapsed_time', 'average_speed',
                      'average_heartrate', 'total_elevation_gain'):
-            if attr in schema:
-                setattr(r, attr, schema[attr])
-            else:
-                setattr(r, attr, None)
+            row[attr] = schema.get(attr)
 
-        setattr(r, 'start_date', datetime.fromtimestamp(schema['start_date']))
+        row['start_date'] = datetime.fromtimestamp(schema['start_date'])
         if 'runned_id' in schema:
-            setattr(r, 'runner_id', schema['runner_id'])
+            row['runner_id'] = schema['runner_id']
         elif runner_id is not None:
-            setattr(r, 'runner_id', runner_id)
+            row['runner_id'] = runner_id
         else:
             raise ValueError("runner_id not set")
 
         if 'id' in schema:
-            setattr(r, 'id', schema['id'])
+            row['id'] = schema['id']
+
+        return row
 
-        return r
+    @staticmethod
+    def from_json(schema, runner_id=None):
+        return Run(**Run.row_from_json(schema, runner_id))
 
 
 def init_database():  # pragma: no cover
@@ -168,3 +201,173 @@ def init_database():  # pragma: no cover
     user.report_periodicity = ReportPeriodicity.No
     db.session.add(user)
     db.session.commit()
+
+
+class RunStats(db.Model):
+    """Totals of the runs of a user in a period, maintained by `ingest_runs`."""
+    __tablename__ = 'run_stats'
+    runner_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    # daily, weekly or monthly
+    period = db.Column(db.String(7), primary_key=True)
+    # the first day of the period
+    bucket = db.Column(db.Date, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    distance = db.Column(db.Float, nullable=False, default=0.0)
+    elapsed_time = db.Column(db.Integer, nullable=False, default=0)
+    total_elevation_gain = db.Column(db.Float, nullable=False, default=0.0)
+    speed_sum = db.Column(db.Float, nullable=False, default=0.0)
+    heartrate_sum = db.Column(db.Float, nullable=False, default=0.0)
+    # runs with an average heartrate
+    heartrate_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def to_json(self):
+        return {'period': self.period,
+                'start': datetime(self.bucket.year, self.bucket.month, self.bucket.day).timestamp(),
+                'count': self.count,
+                'distance': self.distance,
+                'elapsed_time': self.elapsed_time,
+                'total_elevation_gain': self.total_elevation_gain,
+                'average_speed': self.speed_sum / self.count if self.count else 0.0,
+                'average_heartrate': (self.heartrate_sum / self.heartrate_count
+                                      if self.heartrate_count else None)}
+
+
+class Change(db.Model):
+    """Append-only log of the changes of users and runs, read by the changes feed."""
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        db.Index('ix_change_log_entity', 'entity', 'entity_id'),
+    )
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # user or run
+    entity = db.Column(db.String(4), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    # insert, update or delete
+    op = db.Column(db.String(6), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_json(self):
+        return {'seq': self.seq, 'entity': self.entity, 'id': self.entity_id,
+                'user_id': self.user_id, 'op': self.op,
+                'time': self.created_at.timestamp()}
+
+
+class Job(db.Model):
+    """A unit of work run by the job worker, out of the request cycle."""
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(64), nullable=False)
+    # the JSON encoded keyword arguments of the job function
+    payload = db.Column(db.Text, nullable=False)
+    # pending, running or failed, once all the attempts are used
+    status = db.Column(db.String(8), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=10)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(128))
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Unicode(512))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+
+
+def row_converter(fields, conversions):
+    """Returns a function turning a row with the values of `fields` into a dict.
+
+    `conversions` maps some of the fields to the function applied to
+    their values when they are not null; the other values are kept as
+    they are.
+    """
+    conversions = tuple((attr, conversion) for attr, conversion in conversions.items() if attr in fields)
+
+    def convert(row):
+        res = dict(zip(fields, row))
+        for attr, conversion in conversions:
+            value = res[attr]
+            if value is not None:
+                res[attr] = conversion(value)
+        return res
+    return convert
+
+
+_USER_CONVERSIONS = {'weight': float, 'vo2max': float,
+                     'report_periodicity': ReportPeriodicity.to_json}
+_user_row_to_json = row_converter(User.JSON_FIELDS, _USER_CONVERSIONS)
+_secure_user_row_to_json = row_converter(User.SECURE_JSON_FIELDS, _USER_CONVERSIONS)
+
+
+@lru_cache(maxsize=128)
+def _user_projection(fields):
+    return row_converter(fields, _USER_CONVERSIONS)
+
+
+_run_row_to_json = row_converter(Run.JSON_FIELDS, {'start_date': datetime.timestamp})
+
+
+def update_user_totals(user_ids=None):
+    """Recomputes total_speed and total_runs from the stored runs."""
+    runs = db.session.query(Run).filter(Run.runner_id == User.id)
+    q = db.session.query(User)
+    if user_ids is not None:
+        q = q.filter(User.id.in_(list(user_ids)))
+    total_speed = func.coalesce(func.sum(Run.average_speed), 0.0)
+    q.update({User.total_runs: runs.with_entities(func.count(Run.id)).as_scalar(),
+              User.total_speed: runs.with_entities(total_speed).as_scalar(),
+              User.revision: User.revision + 1,
+              User.updated_at: datetime.utcnow()},
+             synchronize_session=False)
+
+
+def _add_missing_columns(model):
+    table = model.__table__
+    existing = set(column['name'] for column in inspect(db.engine).get_columns(table.name))
+    preparer = db.engine.dialect.identifier_preparer
+    for column in table.columns:
+        if column.name not in existing:
+            definition = CreateColumn(column).compile(dialect=db.engine.dialect)
+            db.engine.execute('ALTER TABLE %s ADD COLUMN %s' % (preparer.format_table(table), definition))
+
+
+def _missing_indexes(model):
+    existing = set(index['name'] for index in inspect(db.engine).get_indexes(model.__tablename__))
+    return [index for index in model.__table__.indexes if index.name not in existing]
+
+
+def upgrade_database():
+    """Brings a database created by an older version up to date.
+
+    `create_all` does not touch existing tables, so the new columns and
+    the indexes of `user` and `run` are created here; duplicated strava
+    ids are removed first (keeping the oldest run) otherwise the unique
+    index could not be built. The removed runs are logged as a warning
+    and in the change log.
+    """
+    _add_missing_columns(User)
+    for index in _missing_indexes(User):
+        index.create(db.engine)
+
+    missing = _missing_indexes(Run)
+    if not missing:
+        return
+
+    # changes and queries import this module
+    from beepbeep.dataservice.changes import log_run_deletes
+    from beepbeep.dataservice.queries import chunks
+
+    keep = db.session.query(func.min(Run.id)).filter(Run.strava_id.isnot(None)).group_by(Run.strava_id)
+    duplicates = db.session.query(Run.id, Run.strava_id).filter(Run.strava_id.isnot(None),
+                                                                ~Run.id.in_(keep)).all()
+    if duplicates:
+        logger.warning('Removing %d runs whose strava id is already stored: %s', len(duplicates),
+                       ', '.join('%d (strava id %d)' % run for run in duplicates))
+        run_ids = [run_id for run_id, _ in duplicates]
+        log_run_deletes(run_ids)
+        for chunk in chunks(run_ids):
+            db.session.query(Run).filter(Run.id.in_(chunk)).delete(synchronize_session=False)
+        update_user_totals()
+    db.session.commit()
+
+    for index in missing:
+        index.create(db.engine)
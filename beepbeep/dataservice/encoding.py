@@ -0,0 +1,47 @@
+import json
+import time
+
+from .metrics import observe
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj).decode('utf8')
+
+
+_dumps = _orjson_dumps if orjson is not None else _json_dumps
+
+
+def set_encoder(name):
+    """Selects the JSON encoder used by `dumps`: `json`, `orjson` or `auto`.
+
+    `auto` picks orjson when it's installed and the json module otherwise.
+    """
+    global _dumps
+    name = name.lower()
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError('orjson is not installed')
+        _dumps = _orjson_dumps
+    elif name == 'json':
+        _dumps = _json_dumps
+    else:
+        raise ValueError('Unknown JSON_ENCODER ' + name)
+
+
+def dumps(obj):
+    """Serializes `obj` to a JSON string with the configured encoder."""
+    start = time.perf_counter()
+    res = _dumps(obj)
+    observe('encode', time.perf_counter() - start)
+    return res
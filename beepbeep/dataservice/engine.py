@@ -0,0 +1,89 @@
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.pool import QueuePool
+
+
+PROFILES = ('default', 'tuned')
+# set on every new SQLite connection by the tuned profile, in this order
+_PRAGMAS = (('journal_mode', 'SQLITE_JOURNAL_MODE', 'WAL'),
+            ('synchronous', 'SQLITE_SYNCHRONOUS', 'NORMAL'),
+            ('busy_timeout', 'SQLITE_BUSY_TIMEOUT', 5000),
+            ('mmap_size', 'SQLITE_MMAP_SIZE', 268435456),
+            ('cache_size', 'SQLITE_CACHE_SIZE', -65536))
+
+
+def profile_options(config, url):
+    """Returns the `create_engine` options of the DB_PROFILE for `url` and the SQLite pragmas.
+
+    The default profile keeps the Flask-SQLAlchemy defaults, the tuned one
+    pools the connections, pre-pinging and recycling them on server
+    databases and setting the pragmas on SQLite ones.
+    """
+    profile = str(config.get('DB_PROFILE', 'default')).lower()
+    if profile not in PROFILES:
+        raise ValueError('Unknown DB_PROFILE ' + profile)
+    if profile == 'default':
+        return {}, ()
+
+    pool = {'pool_size': int(config.get('DB_POOL_SIZE', 10)),
+            'max_overflow': int(config.get('DB_MAX_OVERFLOW', 20)),
+            'pool_timeout': float(config.get('DB_POOL_TIMEOUT', 30))}
+    if url.drivername != 'sqlite':
+        pool['pool_pre_ping'] = bool(config.get('DB_POOL_PRE_PING', True))
+        pool['pool_recycle'] = int(config.get('DB_POOL_RECYCLE', 1800))
+        return pool, ()
+
+    pragmas = tuple((pragma, config.get(key, default)) for pragma, key, default in _PRAGMAS)
+    if url.database in (None, '', ':memory:'):
+        # a single connection is shared, and there is no journal
+        return {}, tuple((pragma, value) for pragma, value in pragmas if pragma != 'journal_mode')
+    # pysqlite doesn't pool file databases by default, and the pooled
+    # connections move between threads
+    pool['poolclass'] = QueuePool
+    pool['connect_args'] = {'check_same_thread': False}
+    return pool, pragmas
+
+
+def set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in pragmas:
+        cursor.execute('PRAGMA %s = %s' % (pragma, value))
+    cursor.close()
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the queries to the replica engine chosen for the request, if any.
+
+    Flushes and DML statements always go to the primary.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('db_replica') if has_app_context() else None
+        if replica is not None and not self._flushing and not isinstance(clause, UpdateBase):
+            return replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension creating the engines with the DB_PROFILE of the app,
+    and routing sessions.
+    """
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        profile, pragmas = profile_options(app.config, sa_url)
+        options.update(profile)
+        sa_url, options = super(ProfiledSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if pragmas:
+            # popped by create_engine, which doesn't get the app
+            options['_pragmas'] = pragmas
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('_pragmas', ())
+        engine = super(ProfiledSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, 'connect', lambda *args: set_pragmas(pragmas, *args))
+        return engine
@@ -0,0 +1,143 @@
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from beepbeep.dataservice.database import db, User, Run, update_user_totals
+from beepbeep.dataservice.cache import cache
+from beepbeep.dataservice.changes import log_run_inserts, log_new_runs
+from beepbeep.dataservice.queries import chunks
+from beepbeep.dataservice.replicas import replicas
+from beepbeep.dataservice.stats import add_to_stats, rebuild_stats
+
+
+def _existing_users(user_ids):
+    found = set()
+    for chunk in chunks(user_ids):
+        q = db.session.query(User.id).filter(User.id.in_(chunk))
+        found.update(user_id for (user_id,) in q)
+    return found
+
+
+def _insert_ignore(table):
+    """An INSERT that silently skips rows violating a unique constraint."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return pg_insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    if dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
+
+
+def _new_rows(rows):
+    """Drops the rows whose strava_id is repeated in `rows` or already stored."""
+    seen = set()
+    unique = []
+    for row in rows:
+        strava_id = row['strava_id']
+        if strava_id is not None:
+            if strava_id in seen:
+                continue
+            seen.add(strava_id)
+        unique.append(row)
+
+    stored = set()
+    for chunk in chunks(seen):
+        q = db.session.query(Run.strava_id).filter(Run.strava_id.in_(chunk))
+        stored.update(strava_id for (strava_id,) in q)
+    return [row for row in unique if row['strava_id'] not in stored]
+
+
+def _insert_anonymous(rows):
+    """Inserts the runs without a strava id and returns them with their id.
+
+    The unique index can't tell them apart, so their id can't be read back
+    through the strava id as for the other runs.
+    """
+    table = Run.__table__
+    if db.session.get_bind().dialect.name != 'sqlite':
+        return [dict(row, id=db.session.execute(table.insert(), row).inserted_primary_key[0]) for row in rows]
+    # SQLite runs a write transaction at a time: the batch takes the ids following the last one
+    db.session.execute(table.insert(), rows)
+    last = db.session.query(func.max(Run.id)).scalar()
+    return [dict(row, id=last - len(rows) + i) for i, row in enumerate(rows, 1)]
+
+
+def _insert_runs(rows):
+    """Inserts `rows`, none of them stored yet.
+
+    Returns how many runs were added, their rows with the id of the new
+    runs, and whether those are all of them: a concurrent ingest can store
+    some of the same strava ids in the meantime, those rows are skipped and
+    the database can't always tell which ones.
+    """
+    table = Run.__table__
+    if db.session.get_bind().dialect.name == 'postgresql':
+        inserted = []
+        for chunk in chunks(rows):
+            stmt = pg_insert(table).values(chunk).on_conflict_do_nothing().returning(*table.columns)
+            inserted.extend(dict(row) for row in db.session.execute(stmt))
+        return len(inserted), inserted, True
+
+    anonymous = [row for row in rows if row['strava_id'] is None]
+    inserted = _insert_anonymous(anonymous) if anonymous else []
+    by_strava_id = {row['strava_id']: row for row in rows if row['strava_id'] is not None}
+    if not by_strava_id:
+        return len(inserted), inserted, True
+
+    res = db.session.execute(_insert_ignore(table), list(by_strava_id.values()))
+    if not res.supports_sane_multi_rowcount() or res.rowcount != len(by_strava_id):
+        return len(inserted) + max(res.rowcount, 0), inserted, False
+    for chunk in chunks(by_strava_id):
+        q = db.session.query(Run.id, Run.strava_id).filter(Run.strava_id.in_(chunk))
+        inserted.extend(dict(by_strava_id[strava_id], id=run_id) for run_id, strava_id in q)
+    return len(inserted), inserted, True
+
+
+def ingest_runs(runs_by_user):
+    """Adds the runs of many users in a single transaction.
+
+    `runs_by_user` maps user ids to lists of runs as described by the
+    `Run` schema. Runs of unknown users are skipped, runs whose
+    `strava_id` is already stored (or repeated in the payload) are
+    dropped. The totals and the statistics of the users are updated with
+    the runs actually added, and recomputed only when a concurrent ingest
+    stored some of them first.
+    Returns the number of runs added.
+    """
+    runs_by_user = {int(user_id): runs for user_id, runs in runs_by_user.items()}
+    rows = []
+    for user_id in _existing_users(runs_by_user):
+        rows.extend(Run.row_from_json(run, user_id) for run in runs_by_user[user_id])
+    rows = _new_rows(rows)
+    if not rows:
+        return 0
+
+    added, inserted, complete = _insert_runs(rows)
+    log_run_inserts([row['id'] for row in inserted])
+    if not complete:
+        users = set(row['runner_id'] for row in rows)
+        update_user_totals(users)
+        rebuild_stats(users)
+        log_new_runs([row['strava_id'] for row in rows if row['strava_id'] is not None])
+    else:
+        totals = defaultdict(lambda: [0.0, 0])
+        for row in inserted:
+            totals[row['runner_id']][0] += row['average_speed'] or 0.0
+            totals[row['runner_id']][1] += 1
+        now = datetime.utcnow()
+        for user_id, (speed, count) in totals.items():
+            db.session.query(User).filter(User.id == user_id).update(
+                {User.total_speed: User.total_speed + speed,
+                 User.total_runs: User.total_runs + count,
+                 User.revision: User.revision + 1,
+                 User.updated_at: now},
+                synchronize_session=False)
+        add_to_stats(inserted)
+        users = set(totals)
+
+    db.session.commit()
+    cache.invalidate_user(*users)
+    replicas.wrote(*users)
+    return added
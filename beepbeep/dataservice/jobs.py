@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, or_
+
+from beepbeep.dataservice.database import db, Job
+from beepbeep.dataservice.remote import run_concurrently
+
+
+logger = logging.getLogger(__name__)
+_JOBS = {}
+
+
+def job(kind):
+    """Registers the decorated function as the one running the jobs of `kind`."""
+    def decorator(func):
+        _JOBS[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(kind, delay=0, max_attempts=None, **payload):
+    """Adds a job calling the `kind` function with the `payload` keyword arguments.
+
+    The job is part of the current transaction: the workers see it only
+    once it's committed.
+    """
+    if kind not in _JOBS:
+        raise ValueError('Unknown job ' + kind)
+    if max_attempts is None:
+        max_attempts = int(current_app.config.get('JOB_MAX_ATTEMPTS', 10))
+    new_job = Job(kind=kind, payload=json.dumps(payload), max_attempts=max_attempts,
+                  run_at=datetime.utcnow() + timedelta(seconds=delay))
+    db.session.add(new_job)
+    return new_job
+
+
+def backoff(attempts, base=5, maximum=3600):
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), maximum))
+
+
+def _due(now):
+    # the running jobs whose lease expired belong to a worker that died
+    return or_(and_(Job.status == 'pending', Job.run_at <= now),
+               and_(Job.status == 'running', Job.locked_until < now))
+
+
+def claim_jobs(worker_id, limit, lease=300):
+    """Locks up to `limit` due jobs for `lease` seconds and returns them.
+
+    Every job is claimed with a conditional update, so two workers never
+    get the same one.
+    """
+    now = datetime.utcnow()
+    ids = db.session.query(Job.id).filter(_due(now)).order_by(Job.run_at).limit(limit)
+    claimed = []
+    for job_id, in ids.all():
+        q = db.session.query(Job).filter(Job.id == job_id, _due(now))
+        if q.update({'status': 'running', 'locked_by': worker_id,
+                     'locked_until': now + timedelta(seconds=lease)}, synchronize_session=False):
+            claimed.append(job_id)
+    db.session.commit()
+    if not claimed:
+        return []
+    return db.session.query(Job).filter(Job.id.in_(claimed)).order_by(Job.run_at).all()
+
+
+def _run(app, kind, payload):
+    func = _JOBS.get(kind)
+    if func is None:
+        raise LookupError('Unknown job ' + kind)
+    with app.app_context():
+        return func(**payload)
+
+
+def run_jobs(worker_id, limit=4, timeout=None, lease=300, executor=None):
+    """Claims up to `limit` jobs and runs them concurrently; returns how many were run.
+
+    A failed job is retried with an exponential backoff, until it used
+    all its attempts and is marked as failed. A job still running after
+    `timeout` seconds keeps its lease: it is retried only once the lease
+    expires, so that two threads never run it at the same time.
+    """
+    jobs = claim_jobs(worker_id, limit, lease)
+    if not jobs:
+        return 0
+    app = current_app._get_current_object()
+    calls = [(_run, (app, j.kind, json.loads(j.payload))) for j in jobs]
+    errors = run_concurrently(calls, timeout, executor)
+
+    now = datetime.utcnow()
+    for j, error in zip(jobs, errors):
+        if error is None:
+            db.session.delete(j)
+            continue
+        j.attempts += 1
+        j.last_error = repr(error)[:512]
+        if j.attempts >= j.max_attempts:
+            logger.error('Job %d %s failed: %r', j.id, j.kind, error)
+            j.status = 'failed'
+            j.locked_by = j.locked_until = None
+        elif isinstance(error, TimeoutError):
+            # its thread may still be running: claimed again when the lease expires
+            continue
+        else:
+            j.locked_by = j.locked_until = None
+            j.status = 'pending'
+            j.run_at = now + backoff(j.attempts)
+    db.session.commit()
+    return len(jobs)
+
+
+class Worker(object):
+    """Runs the jobs, at most `concurrency` at a time, polling every `interval` seconds when idle."""
+    def __init__(self, app, concurrency=4, interval=5, timeout=None, lease=300, worker_id=None):
+        self.app = app
+        self.concurrency = concurrency
+        self.interval = interval
+        self.timeout = timeout
+        self.lease = lease
+        self.worker_id = worker_id or '%s:%d' % (socket.gethostname(), os.getpid())
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._halt = threading.Event()
+
+    def run_once(self):
+        with self.app.app_context():
+            try:
+                return run_jobs(self.worker_id, self.concurrency, self.timeout,
+                                self.lease, self._executor)
+            except Exception:
+                logger.exception('Error running the jobs')
+                db.session.rollback()
+                return 0
+
+    def run(self):
+        while not self._halt.is_set():
+            if self.run_once() < self.concurrency:
+                self._halt.wait(self.interval)
+        self._executor.shutdown()
+
+    def stop(self):
+        self._halt.set()
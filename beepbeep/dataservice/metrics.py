@@ -0,0 +1,235 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import time
+from bisect import bisect_left
+from threading import Lock
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+
+def _labels(names, values):
+    if _worker_label:
+        names, values = ('worker',) + tuple(names), (os.getpid(),) + tuple(values)
+    if not names:
+        return ''
+    pairs = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def expose(self):
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s histogram' % self.name
+        with self._lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '%s_bucket%s %d' % (self.name, _labels(self.labels + ('le',), labels + (bound,)),
+                                          cumulative)
+            yield '%s_sum%s %r' % (self.name, _labels(self.labels, labels), total)
+            yield '%s_count%s %d' % (self.name, _labels(self.labels, labels), cumulative)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge(object):
+    """Gauge whose values, by labels, are read from `collect` at every scrape."""
+    def __init__(self, name, help, labels, collect):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def expose(self):
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s gauge' % self.name
+        for labels, value in sorted(self.collect().items()):
+            yield '%s%s %r' % (self.name, _labels(self.labels, labels), float(value))
+
+
+REQUEST_SECONDS = Histogram('beepbeep_request_duration_seconds', 'Time spent handling the requests',
+                            ('operation', 'method', 'status'))
+SQL_QUERIES = Histogram('beepbeep_request_sql_queries', 'SQL queries run by each request',
+                        ('operation',), COUNT_BUCKETS)
+SQL_SECONDS = Histogram('beepbeep_request_sql_seconds', 'Time spent running SQL queries in each request',
+                        ('operation',))
+ENCODE_SECONDS = Histogram('beepbeep_request_json_encode_seconds',
+                           'Time spent encoding JSON in each request', ('operation',))
+AUTH_SECONDS = Histogram('beepbeep_request_auth_seconds', 'Time spent verifying the JWT of each request',
+                         ('operation',))
+HISTOGRAMS = [REQUEST_SECONDS, SQL_QUERIES, SQL_SECONDS, ENCODE_SECONDS, AUTH_SECONDS]
+
+_gauges = {}
+_operations = {}
+_worker_label = False
+enabled = False
+
+
+def _request_metrics():
+    if enabled and has_request_context():
+        return g.get('_metrics')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _request_metrics() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics = _request_metrics()
+    if metrics is not None and conn.info.get('query_start'):
+        metrics['sql_queries'] += 1
+        metrics['sql_seconds'] += time.perf_counter() - conn.info['query_start'].pop()
+
+
+def observe(phase, seconds):
+    """Adds `seconds` to the time spent in `phase` (encode or auth) by the current request."""
+    metrics = _request_metrics()
+    if metrics is not None:
+        metrics[phase + '_seconds'] += seconds
+
+
+def _routes(ops):
+    return {(op['path'].replace('{', '<').replace('}', '>'), op['method']): operation_id
+            for operation_id, op in ops.items()}
+
+
+def operation():
+    rule = request.url_rule
+    if rule is None:
+        return 'unmatched'
+    return _operations.get((rule.rule, request.method), request.endpoint)
+
+
+def add_gauge(name, help, labels, collect):
+    """Exposes the values returned by `collect`, replacing any gauge with the same name."""
+    _gauges[name] = Gauge(name, help, labels, collect)
+
+
+def label_workers(label=True):
+    """Adds the pid of the process as a `worker` label to all the metrics.
+
+    The metrics are kept by each process: the prefork workers each expose
+    their own and a scrape is answered by any of them. Labelled by worker,
+    the series of the workers don't overwrite one another and are summed
+    on the Prometheus side, e.g. `sum without (worker) (...)`.
+    """
+    global _worker_label
+    _worker_label = label
+
+
+def render():
+    """Returns all the metrics in the Prometheus text format."""
+    lines = []
+    for metric in HISTOGRAMS + list(_gauges.values()):
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+def _dump_profile(profiler, directory, seconds):
+    os.makedirs(directory, exist_ok=True)
+    name = '%s-%s-%d-%d' % (time.strftime('%Y%m%dT%H%M%S'), operation(), os.getpid(),
+                            int(seconds * 1000))
+    path = os.path.join(directory, name)
+    profiler.dump_stats(path + '.prof')
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(40)
+    with open(path + '.txt', 'w') as f:
+        f.write('%s %s %.3fs\n' % (request.method, request.full_path, seconds))
+        f.write(out.getvalue())
+
+
+def init_metrics(app, ops):
+    """Instruments the requests of `app`, labelled by the operationIds of `ops`.
+
+    `ops` are the operations of a SwaggerBlueprint. Must be called before
+    any other `before_request` hook so that their time is measured. With
+    PROFILE_SAMPLE_RATE > 0 that fraction of the
+    requests is run under cProfile, and the ones slower than
+    PROFILE_SLOW_SECONDS are dumped in PROFILE_DIR.
+    """
+    global enabled, _operations
+    config = app.config
+    enabled = bool(config.get('METRICS', True))
+    if not enabled:
+        return
+    _operations = _routes(ops)
+    sample_rate = float(config.get('PROFILE_SAMPLE_RATE', 0))
+    slow = float(config.get('PROFILE_SLOW_SECONDS', 1))
+    directory = config.get('PROFILE_DIR', '/tmp/beepbeep-profiles')
+
+    @app.before_request
+    def _start():
+        g._metrics = {'start': time.perf_counter(), 'status': 500, 'sql_queries': 0,
+                      'sql_seconds': 0.0, 'encode_seconds': 0.0, 'auth_seconds': 0.0}
+        if sample_rate > 0 and random.random() < sample_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiler is running in this process
+                return
+            g._profiler = profiler
+
+    @app.after_request
+    def _status(response):
+        metrics = g.get('_metrics')
+        if metrics is not None:
+            metrics['status'] = response.status_code
+        return response
+
+    @app.teardown_request
+    def _finish(exc):
+        # streamed responses are torn down once they are written
+        metrics = g.pop('_metrics', None)
+        if metrics is None:
+            return
+        seconds = time.perf_counter() - metrics['start']
+        profiler = g.pop('_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            if seconds >= slow:
+                _dump_profile(profiler, directory, seconds)
+
+        op = operation()
+        REQUEST_SECONDS.observe(seconds, op, request.method, str(metrics['status']))
+        SQL_QUERIES.observe(metrics['sql_queries'], op)
+        SQL_SECONDS.observe(metrics['sql_seconds'], op)
+        ENCODE_SECONDS.observe(metrics['encode_seconds'], op)
+        if metrics['auth_seconds']:
+            AUTH_SECONDS.observe(metrics['auth_seconds'], op)
@@ -0,0 +1,176 @@
+import os
+import random
+import signal
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+from werkzeug.serving import BaseWSGIServer
+
+from beepbeep.dataservice.database import db
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server handling the connections on a pool of `threads` threads.
+
+    A connection is accepted only once a thread is free to handle it, so
+    the busy workers leave the new ones to the others.
+    """
+    multiprocess = True
+
+    def __init__(self, host, port, app, threads=1, fd=None):
+        super(PooledWSGIServer, self).__init__(host, port, app, fd=fd)
+        self.multithread = threads > 1
+        self.handled = 0
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._slots = BoundedSemaphore(threads)
+
+    def get_request(self):
+        self._slots.acquire()
+        try:
+            return super(PooledWSGIServer, self).get_request()
+        except BaseException:
+            # another worker accepted the connection
+            self._slots.release()
+            raise
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        self._pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def close(self):
+        # waits for the requests being handled
+        self._pool.shutdown(wait=True)
+        self.server_close()
+
+
+def _worker(app, listener, threads, max_requests):
+    """Serves `listener` in a forked process until SIGTERM or `max_requests` connections."""
+    running = [True]
+
+    def _stop(signum, frame):
+        running[0] = False
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # the connections opened by the master can't be shared with it
+    with app.app_context():
+        db.engine.dispose()
+
+    host, port = listener.getsockname()[:2]
+    server = PooledWSGIServer(host, port, app, threads=threads, fd=listener.fileno())
+    # all the workers wait on the socket, the ones losing the race must not block
+    server.socket.setblocking(False)
+    server.timeout = 0.5
+    while running[0] and (max_requests <= 0 or server.handled < max_requests):
+        server.handle_request()
+    server.close()
+
+
+class Arbiter(object):
+    """Pre-forks `workers` processes serving the same listening socket.
+
+    SIGTERM and SIGINT stop the workers gracefully, SIGHUP replaces them
+    with new ones created by `app_factory`, reading the settings again,
+    and the workers recycled after `max_requests` connections are
+    replaced as well.
+    """
+    def __init__(self, app_factory, host, port, workers=None, threads=1, max_requests=0,
+                 max_requests_jitter=0, graceful_timeout=30, backlog=2048):
+        self.app_factory = app_factory
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(backlog)
+        self.children = set()
+        self._stopping = False
+        self._reload = False
+
+    def spawn(self, app):
+        max_requests = self.max_requests
+        if max_requests > 0 and self.max_requests_jitter > 0:
+            # spreads the recycling of the workers in time
+            max_requests += random.randint(0, self.max_requests_jitter)
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+        status = 0
+        try:
+            _worker(app, self.listener, self.threads, max_requests)
+        except Exception:
+            status = 1
+            sys.excepthook(*sys.exc_info())
+        finally:
+            os._exit(status)
+
+    def stop(self, signum=None, frame=None):
+        self._stopping = True
+
+    def reload(self, signum=None, frame=None):
+        self._reload = True
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            self.children.discard(pid)
+
+    def _terminate(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + self.graceful_timeout
+        while any(pid in self.children for pid in pids) and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in pids:
+            if pid in self.children:
+                os.kill(pid, signal.SIGKILL)
+        while any(pid in self.children for pid in pids):
+            self._reap()
+            time.sleep(0.01)
+
+    def run(self, app):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        while not self._stopping:
+            if self._reload:
+                self._reload = False
+                old = list(self.children)
+                app = self.app_factory()
+                for _ in range(self.workers):
+                    self.spawn(app)
+                self._terminate(old)
+            self._reap()
+            while len(self.children) < self.workers and not self._stopping:
+                self.spawn(app)
+            time.sleep(0.2)
+        self._terminate(list(self.children))
+        self.listener.close()
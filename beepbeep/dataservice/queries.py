@@ -0,0 +1,49 @@
+from sqlalchemy import exists
+from beepbeep.dataservice.database import db, User, Run
+
+
+# keep every IN (...) below the SQLite host-parameter limit
+CHUNK = 500
+
+
+def chunks(values, size=CHUNK):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def get_user(user_id):
+    """Returns the User with the given primary key or None.
+
+    Served from the session identity map when the user is already loaded.
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    return db.session.query(User).get(user_id)
+
+
+def get_run(user_id, run_id):
+    q = db.session.query(Run).filter(Run.id == run_id, Run.runner_id == user_id)
+    return q.first()
+
+
+def user_exists(user_id):
+    return db.session.query(exists().where(User.id == user_id)).scalar()
+
+
+def email_exists(email):
+    return db.session.query(exists().where(User.email == email)).scalar()
+
+
+def get_user_totals(user_id):
+    """Returns the (total_speed, total_runs, revision, updated_at) of a user or None."""
+    q = db.session.query(User.total_speed, User.total_runs, User.revision, User.updated_at)
+    return q.filter(User.id == user_id).first()
+
+
+def get_user_version(user_id):
+    """Returns the (revision, updated_at) of a user or None."""
+    q = db.session.query(User.revision, User.updated_at).filter(User.id == user_id)
+    return q.first()
@@ -0,0 +1,37 @@
+import argparse
+import sys
+
+from beepbeep.dataservice.app import create_app
+from beepbeep.dataservice.database import db, upgrade_database
+from beepbeep.dataservice.jobs import enqueue
+from beepbeep.dataservice.stats import rebuild_stats, invalidate_stats
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Rebuilds the run statistics of the beepbeep Dataservice')
+
+    parser.add_argument('--config-file', help='Config file',
+                        type=str, default=None)
+    parser.add_argument('--user', help='Only rebuild the statistics of this user, can be repeated',
+                        type=int, action='append', default=None)
+    parser.add_argument('--enqueue', help='Leave the rebuild to the job worker',
+                        action='store_true')
+    args = parser.parse_args(args=args)
+
+    app = create_app(args.config_file)
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        upgrade_database()
+        if args.enqueue:
+            enqueue('rebuild_stats', user_ids=args.user)
+            db.session.commit()
+        else:
+            rebuild_stats(args.user)
+            db.session.commit()
+            invalidate_stats(args.user)
+    print("Rebuild enqueued" if args.enqueue else "Statistics rebuilt")
+
+
+if __name__ == "__main__":
+    main()
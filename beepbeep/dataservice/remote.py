@@ -0,0 +1,182 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, TimeoutError
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+_executor = ThreadPoolExecutor(max_workers=16)
+
+# the methods that can be sent again when the response is lost
+IDEMPOTENT = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+RETRY_STATUSES = frozenset((502, 503, 504))
+
+
+def run_concurrently(calls, timeout=None, executor=None):
+    """Runs the `(func, args)` calls in parallel, waiting at most `timeout` seconds.
+
+    Returns, in the order of `calls`, the exception raised by each call,
+    None for the calls that succeeded and a TimeoutError for the ones
+    that didn't complete in time (they are left running). The calls
+    share a module wide thread pool unless `executor` is given.
+    """
+    executor = executor or _executor
+    futures = [executor.submit(func, *args) for func, args in calls]
+    done, _ = wait(futures, timeout=timeout)
+    errors = []
+    for future in futures:
+        if future in done:
+            errors.append(future.exception())
+        else:
+            future.cancel()
+            errors.append(TimeoutError('call not completed in %s seconds' % timeout))
+    return errors
+
+
+class RetryBudget(object):
+    """Limits the retries to a `ratio` of the requests, plus `minimum` in reserve.
+
+    Every request deposits `ratio` tokens and every retry withdraws one,
+    so a failing service gets at most `ratio` times more traffic.
+    """
+    def __init__(self, ratio=0.2, minimum=10):
+        self.ratio = ratio
+        self.maximum = minimum + ratio * 100
+        self._tokens = float(minimum)
+        self._lock = Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.maximum, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class PooledSession(requests.Session):
+    """Session sending its requests through `pool`, for the clients taking one, as stravalib."""
+    def __init__(self, pool):
+        super(PooledSession, self).__init__()
+        self.pool = pool
+
+    def request(self, method, url, **kwargs):
+        return self.pool.request(method, url, **kwargs)
+
+
+class HTTPPool(object):
+    """Process wide session keeping alive up to `size` connections per service.
+
+    When all the connections to a service are busy the calls wait for one
+    to be released; `stats` tells how often it happens. `client_session`
+    is given to the third-party clients so that their calls get the same
+    timeouts, retries and stats.
+    """
+    def __init__(self, size=10, connect_timeout=3.05, read_timeout=10, retries=2,
+                 backoff=0.2, budget=None):
+        self._lock = Lock()
+        self.configure(size, connect_timeout, read_timeout, retries, backoff, budget)
+
+    def init_app(self, app):
+        config = app.config
+        budget = RetryBudget(ratio=float(config.get('HTTP_RETRY_BUDGET', 0.2)),
+                             minimum=int(config.get('HTTP_RETRY_MIN', 10)))
+        self.configure(size=int(config.get('HTTP_POOL_SIZE', 10)),
+                       connect_timeout=float(config.get('HTTP_CONNECT_TIMEOUT', 3.05)),
+                       read_timeout=float(config.get('HTTP_READ_TIMEOUT', 10)),
+                       retries=int(config.get('HTTP_RETRIES', 2)),
+                       backoff=float(config.get('HTTP_RETRY_BACKOFF', 0.2)),
+                       budget=budget)
+
+    def configure(self, size=10, connect_timeout=3.05, read_timeout=10, retries=2,
+                  backoff=0.2, budget=None):
+        self.size = size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.budget = budget or RetryBudget()
+        if getattr(self, 'session', None) is not None:
+            self.session.close()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.client_session = PooledSession(self)
+        self._in_flight = 0
+        self._hosts = {}
+        self._stats = {'requests': 0, 'retries': 0, 'errors': 0, 'saturated': 0,
+                       'budget_exhausted': 0, 'max_in_flight': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _send(self, method, url, **kwargs):
+        # the connections are pooled by service, so is the saturation
+        host = urlsplit(url)[:2]
+        with self._lock:
+            self._in_flight += 1
+            self._hosts[host] = self._hosts.get(host, 0) + 1
+            self._stats['requests'] += 1
+            self._stats['max_in_flight'] = max(self._stats['max_in_flight'], self._in_flight)
+            if self._hosts[host] > self.size:
+                self._stats['saturated'] += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._hosts[host] -= 1
+                if not self._hosts[host]:
+                    del self._hosts[host]
+
+    def request(self, method, url, **kwargs):
+        """Sends a request, retrying the idempotent ones on connection errors and 502/503/504."""
+        method = method.upper()
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            self.budget.deposit()
+            try:
+                response = self._send(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if method not in IDEMPOTENT or attempt >= self.retries:
+                break
+            if not self.budget.withdraw():
+                self._count('budget_exhausted')
+                break
+            self._count('retries')
+            attempt += 1
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+
+        self._count('errors')
+        if error is not None:
+            raise error
+        return response
+
+    def delete(self, url, **kwargs):
+        """Deletes `url`, raising a RequestException unless it's gone."""
+        response = self.request('DELETE', url, **kwargs)
+        if response.status_code != 404:
+            response.raise_for_status()
+        return response
+
+    def stats(self):
+        with self._lock:
+            res = dict(self._stats)
+            res['in_flight'] = self._in_flight
+        res['size'] = self.size
+        return res
+
+
+http = HTTPPool()
+
@@ -0,0 +1,110 @@
+import logging
+import re
+import time
+from threading import Lock
+
+from flask import g, request
+from sqlalchemy.engine.url import make_url
+
+from beepbeep.dataservice.cache import MemoryCache, cache
+from beepbeep.dataservice.database import db
+
+
+logger = logging.getLogger(__name__)
+READ_METHODS = ('GET', 'HEAD')
+
+
+class Replica(object):
+    def __init__(self, app, uri):
+        self.uri = uri
+        self.healthy = True
+        self.checked = 0
+        self._app = app
+        self._engine = None
+
+    @property
+    def engine(self):
+        # created as the primary one, with the DB_PROFILE
+        if self._engine is None:
+            url, options = db.apply_driver_hacks(self._app, make_url(self.uri), {})
+            self._engine = db.create_engine(url, options)
+        return self._engine
+
+
+class ReplicaRouter(object):
+    """Routes the read-only requests to the SQLALCHEMY_REPLICA_URIS, round-robin.
+
+    A replica is used only while its health check, run at most every
+    REPLICA_CHECK_INTERVAL seconds, succeeds. The requests about a user
+    written in the last READ_YOUR_WRITES_WINDOW seconds are sent to the
+    primary, as the requests writing anything.
+    """
+    def __init__(self):
+        self.replicas = []
+        self.check_interval = 5
+        self.window = 5
+        self._next = 0
+        self._lock = Lock()
+        self._written = MemoryCache(size=4096)
+
+    def init_app(self, app):
+        config = app.config
+        uris = re.split(r'[\s,]+', str(config.get('SQLALCHEMY_REPLICA_URIS') or '').strip())
+        self.replicas = [Replica(app, uri) for uri in uris if uri]
+        self.check_interval = float(config.get('REPLICA_CHECK_INTERVAL', 5))
+        self.window = float(config.get('READ_YOUR_WRITES_WINDOW', 5))
+        self._written = MemoryCache(size=4096, ttl=self.window)
+
+        @app.before_request
+        def _route():
+            if self.replicas and request.method in READ_METHODS:
+                user_id = (request.view_args or {}).get('user_id')
+                if user_id is None or not self.recently_written(user_id):
+                    g.db_replica = self.choose()
+
+    def _backend(self):
+        # the shared cache, when there's one, tells the other processes too
+        return self._written if cache.backend is None else cache.backend
+
+    def wrote(self, *user_ids):
+        """Sends the reads about `user_ids` to the primary for READ_YOUR_WRITES_WINDOW seconds."""
+        if not self.replicas or self.window <= 0:
+            return
+        backend = self._backend()
+        for user_id in user_ids:
+            backend.set('written:%d' % int(user_id), '1', self.window)
+
+    def recently_written(self, user_id):
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            return False
+        return self._backend().get('written:%d' % user_id) is not None
+
+    def _healthy(self, replica):
+        now = time.time()
+        if now - replica.checked >= self.check_interval:
+            replica.checked = now
+            try:
+                with replica.engine.connect() as conn:
+                    conn.execute('SELECT 1')
+                replica.healthy = True
+            except Exception as e:
+                if replica.healthy:
+                    logger.warning('Replica %s is down: %r', replica.uri, e)
+                replica.healthy = False
+        return replica.healthy
+
+    def choose(self):
+        """Returns the engine of the next healthy replica, or None to use the primary."""
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if self._healthy(replica):
+                return replica.engine
+        return None
+
+
+replicas = ReplicaRouter()
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+from sqlalchemy import and_, case, func
+from beepbeep.dataservice.database import db, User, Run, ReportPeriodicity
+from beepbeep.dataservice.stats import period_start
+
+
+# the report periodicities and the statistics period they cover
+PERIODICITIES = {ReportPeriodicity.Daily: 'daily',
+                 ReportPeriodicity.Weekly: 'weekly',
+                 ReportPeriodicity.Monthly: 'monthly'}
+_USER_FIELDS = ('id', 'email', 'firstname', 'lastname')
+_TOTALS = ('count', 'distance', 'elapsed_time', 'total_elevation_gain',
+           'average_speed', 'average_heartrate')
+
+
+def _midnight(day):
+    return datetime(day.year, day.month, day.day)
+
+
+def report_window(periodicity, now=None):
+    """Returns the start and end of the last complete period of `periodicity`."""
+    period = PERIODICITIES[periodicity]
+    end = _midnight(period_start(period, now or datetime.utcnow()))
+    return _midnight(period_start(period, end - timedelta(days=1))), end
+
+
+def report_query(periodicity, start, end, after=None):
+    """Returns the active users with `periodicity` and the totals of their runs in [`start`, `end`).
+
+    One grouped query, ordered by user id and starting after the `after` one.
+    """
+    in_window = and_(Run.runner_id == User.id, Run.start_date >= start, Run.start_date < end)
+    heartrate = case([(Run.average_heartrate > 0, Run.average_heartrate)])
+    q = db.session.query(User.id, User.email, User.firstname, User.lastname,
+                         func.count(Run.id),
+                         func.coalesce(func.sum(Run.distance), 0.0),
+                         func.coalesce(func.sum(Run.elapsed_time), 0),
+                         func.coalesce(func.sum(Run.total_elevation_gain), 0.0),
+                         func.avg(Run.average_speed),
+                         func.avg(heartrate))
+    q = q.outerjoin(Run, in_window)
+    q = q.filter(User.report_periodicity == periodicity, User.is_active.isnot(False))
+    if after is not None:
+        q = q.filter(User.id > after)
+    return q.group_by(User.id, User.email, User.firstname, User.lastname).order_by(User.id)
+
+
+def report_row_to_json(row):
+    res = dict(zip(_USER_FIELDS, row[:len(_USER_FIELDS)]))
+    res['totals'] = dict(zip(_TOTALS, row[len(_USER_FIELDS):]))
+    return res
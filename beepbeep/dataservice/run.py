@@ -6,7 +6,11 @@ from chaussette.server import make_server
 from werkzeug.serving import run_with_reloader
 
 from beepbeep.dataservice.app import create_app
-from beepbeep.dataservice.database import db, init_database
+from beepbeep.dataservice import metrics
+from beepbeep.dataservice.cache import cache
+from beepbeep.dataservice.database import db, init_database, upgrade_database
+from beepbeep.dataservice.replicas import replicas
+from beepbeep.dataservice.prefork import Arbiter
 
 
 def _quit(signal, frame):
@@ -15,31 +19,81 @@ def _quit(signal, frame):
     sys.exit(0)
 
 
+def _load_app(config_file):
+    app = create_app(config_file)
+    db.init_app(app)
+    db.app = app
+    return app
+
+
+def _prefork_app(app):
+    # every worker has its own metrics
+    metrics.label_workers()
+    # a worker can't invalidate the responses cached in the memory of the others
+    if str(app.config.get('CACHE_BACKEND', 'memory')).lower() == 'memory':
+        print('The memory cache is disabled in prefork mode, use CACHE_BACKEND = redis',
+              file=sys.stderr)
+        app.config['CACHE_BACKEND'] = 'none'
+        cache.init_app(app)
+    # the writes are remembered in the shared cache for the next reads, wherever they land
+    if replicas.replicas and cache.backend is None:
+        print('The read replicas need CACHE_BACKEND = redis in prefork mode: without it a client may '
+              'not read its own writes', file=sys.stderr)
+    return app
+
+
 def main(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(description='beepbeep Dataservice')
 
     parser.add_argument('--fd', type=int, default=None)
     parser.add_argument('--config-file', help='Config file',
                         type=str, default=None)
+    parser.add_argument('--host', type=str, default=None)
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--mode', help='development or prefork',
+                        choices=('development', 'prefork'), default=None)
+    parser.add_argument('--workers', help='Worker processes of the prefork mode, 0 for one per CPU',
+                        type=int, default=None)
+    parser.add_argument('--threads', help='Threads of each worker process',
+                        type=int, default=None)
+    parser.add_argument('--max-requests', help='Connections served before a worker is replaced, 0 for never',
+                        type=int, default=None)
     args = parser.parse_args(args=args)
 
-    app = create_app(args.config_file)
-    host = app.config.get('host', '0.0.0.0')
-    port = app.config.get('port', 5000)
-    debug = app.config.get('DEBUG', False)
+    app = _load_app(args.config_file)
+    config = app.config
+    host = args.host or config.get('host', '0.0.0.0')
+    port = args.port or config.get('port', 5000)
+    debug = config.get('DEBUG', False)
+    mode = args.mode or config.get('SERVER_MODE', 'development')
 
     signal.signal(signal.SIGINT, _quit)
     signal.signal(signal.SIGTERM, _quit)
 
-    db.init_app(app)
-    db.app = app
     db.create_all(app=app)
+    upgrade_database()
     init_database()
 
     if args.fd is not None:
         # use chaussette
         httpd = make_server(app, host='fd://%d' % args.fd)
         httpd.serve_forever()
+    elif mode == 'prefork':
+        def _option(name, key, default):
+            value = getattr(args, name)
+            return value if value is not None else int(config.get(key, default))
+
+        app = _prefork_app(app)
+        arbiter = Arbiter(lambda: _prefork_app(_load_app(args.config_file)), host, port,
+                          workers=_option('workers', 'WORKERS', 0),
+                          threads=_option('threads', 'THREADS', 4),
+                          max_requests=_option('max_requests', 'MAX_REQUESTS', 0),
+                          max_requests_jitter=int(config.get('MAX_REQUESTS_JITTER', 0)),
+                          graceful_timeout=float(config.get('GRACEFUL_TIMEOUT', 30)),
+                          backlog=int(config.get('BACKLOG', 2048)))
+        # SIGTERM and SIGINT stop the workers gracefully before quitting
+        arbiter.run(app)
+        _quit(None, None)
     else:
         app.run(debug=debug, host=host, port=port, use_reloader=debug)
 
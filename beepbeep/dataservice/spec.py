@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import tempfile
+from functools import wraps
+
+import yaml
+from flask import request, abort
+from flakon import SwaggerBlueprint
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader as _Loader
+
+
+def _cache_dir(path, cache_dir=None):
+    cache_dir = cache_dir or os.environ.get('BEEPBEEP_SPEC_CACHE')
+    return cache_dir or os.path.join(os.path.dirname(path), '__pycache__')
+
+
+def compile_spec(data):
+    """Parses the YAML swagger spec in `data`."""
+    return yaml.load(data, Loader=_Loader)
+
+
+def cached_spec(path, cache_dir=None):
+    """Returns the path of the swagger spec in `path` compiled to JSON, which flakon reads fastest.
+
+    The JSON, in `cache_dir`, BEEPBEEP_SPEC_CACHE or `__pycache__` next to
+    the spec, is named after the SHA-256 of the spec, so it's used as long
+    as the content is the same. `path` itself is returned when the cache
+    can't be written.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    directory = _cache_dir(path, cache_dir)
+    name = os.path.basename(path)
+    cache_name = '%s.%s.json' % (name, hashlib.sha256(data).hexdigest()[:16])
+    cache_path = os.path.join(directory, cache_name)
+    if os.path.exists(cache_path):
+        return cache_path
+
+    try:
+        content = json.dumps(compile_spec(data))
+    except (TypeError, ValueError):
+        # the YAML has values, as dates, that JSON can't hold
+        return path
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        # the workers starting together never read a partial file
+        os.replace(tmp, cache_path)
+        for entry in os.listdir(directory):
+            if entry.startswith(name + '.') and entry.endswith('.json') and entry != cache_name:
+                os.unlink(os.path.join(directory, entry))
+    except OSError:
+        # a read-only install parses the spec every time
+        return path
+    return cache_path
+
+
+def _body_validator(spec, op):
+    schema = op.get('requestBody', {}).get('content', {}).get('application/json', {}).get('schema')
+    if schema is None:
+        return None
+    schema = dict(schema, components=spec.get('components', {}))
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def _validating(f, validator):
+    @wraps(f)
+    def _validated(*args, **kw):
+        error = best_match(validator.iter_errors(request.get_json(force=True, silent=True)))
+        if error is not None:
+            abort(400, error.message)
+        return f(*args, **kw)
+    return _validated
+
+
+class CachedSwaggerBlueprint(SwaggerBlueprint):
+    """SwaggerBlueprint reading its spec, a local file, through `cached_spec`.
+
+    The JSON bodies of the requests are checked with a validator compiled
+    once per operation, whose resolved `$ref`s are kept between requests.
+    """
+    def __init__(self, name, import_name, swagger_spec, cache_dir=None, **options):
+        super(CachedSwaggerBlueprint, self).__init__(name, import_name,
+                                                     cached_spec(swagger_spec, cache_dir), **options)
+        self.validators = {}
+        for operation_id, op in self.ops.items():
+            validator = _body_validator(self.spec, op)
+            if validator is not None:
+                self.validators[operation_id] = validator
+
+    def operation(self, operation_id, **options):
+        def decorator(f):
+            endpoint = options.pop('endpoint', f.__name__)
+            if 'methods' in options:
+                raise ValueError("You can't pass the methods")
+            op = self.ops[operation_id]
+            path = op['path'].replace('{', '<').replace('}', '>')
+            view = f
+            if operation_id in self.validators:
+                view = _validating(f, self.validators[operation_id])
+            self.add_url_rule(path, endpoint, view, methods=[op['method']], **options)
+            return f
+        return decorator
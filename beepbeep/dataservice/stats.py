@@ -0,0 +1,184 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import and_, bindparam, text, Date
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from beepbeep.dataservice.cache import cache
+from beepbeep.dataservice.database import db, Run, RunStats, User
+from beepbeep.dataservice.jobs import job
+from beepbeep.dataservice.queries import chunks
+
+
+PERIODS = ('daily', 'weekly', 'monthly')
+# the Run columns the statistics are computed from
+_SOURCE = ('runner_id', 'start_date', 'distance', 'elapsed_time',
+           'total_elevation_gain', 'average_speed', 'average_heartrate')
+_KEY = ('runner_id', 'period', 'bucket')
+_FIELDS = ('count', 'distance', 'elapsed_time', 'total_elevation_gain',
+           'speed_sum', 'heartrate_sum', 'heartrate_count')
+
+
+def period_start(period, when):
+    """Returns the first day of the `period` containing `when`."""
+    day = when.date() if isinstance(when, datetime) else when
+    if period == 'daily':
+        return day
+    if period == 'weekly':
+        return day - timedelta(days=day.weekday())
+    if period == 'monthly':
+        return day.replace(day=1)
+    raise ValueError('Unknown period ' + str(period))
+
+
+def _aggregate(rows):
+    stats = defaultdict(lambda: [0, 0.0, 0, 0.0, 0.0, 0.0, 0])
+    for runner_id, start_date, distance, elapsed_time, elevation, speed, heartrate in rows:
+        for period in PERIODS:
+            values = stats[runner_id, period, period_start(period, start_date)]
+            values[0] += 1
+            values[1] += distance or 0.0
+            values[2] += elapsed_time or 0
+            values[3] += elevation or 0.0
+            values[4] += speed or 0.0
+            if heartrate:
+                values[5] += heartrate
+                values[6] += 1
+    return stats
+
+
+def _row(key, values):
+    row = dict(zip(_FIELDS, values))
+    row['runner_id'], row['period'], row['bucket'] = key
+    return row
+
+
+def _existing_buckets(stats):
+    buckets = defaultdict(set)
+    for runner_id, _, bucket in stats:
+        buckets[runner_id].add(bucket)
+
+    existing = set()
+    for runner_id, days in buckets.items():
+        for chunk in chunks(days):
+            q = db.session.query(RunStats.period, RunStats.bucket)
+            q = q.filter(RunStats.runner_id == runner_id, RunStats.bucket.in_(chunk))
+            existing.update((runner_id, period, bucket) for period, bucket in q)
+    return existing
+
+
+def _upsert(table):
+    """An INSERT adding its values to the ones of the row with the same key, if any.
+
+    None when the database doesn't support it.
+    """
+    dialect = db.session.get_bind().dialect
+    if dialect.name == 'postgresql':
+        stmt = pg_insert(table)
+        totals = {attr: table.c[attr] + stmt.excluded[attr] for attr in _FIELDS}
+        return stmt.on_conflict_do_update(index_elements=_KEY, set_=totals)
+    if dialect.name == 'sqlite' and dialect.server_version_info >= (3, 24):
+        columns = _KEY + _FIELDS
+        sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s' % (
+            table.name, ', '.join(columns), ', '.join(':' + attr for attr in columns), ', '.join(_KEY),
+            ', '.join('%s = %s + excluded.%s' % (attr, attr, attr) for attr in _FIELDS))
+        return text(sql).bindparams(bindparam('bucket', type_=Date))
+    return None
+
+
+def add_to_stats(rows):
+    """Adds the runs described by `rows` (as built by `Run.row_from_json`) to the statistics.
+
+    The buckets are upserted with a single executemany, so that concurrent
+    ingests can't race on their creation. Without upserts they are read
+    with one query per user, then updated and created with an executemany
+    each.
+    """
+    stats = _aggregate(tuple(row[attr] for attr in _SOURCE) for row in rows)
+    if not stats:
+        return
+
+    upsert = _upsert(RunStats.__table__)
+    if upsert is not None:
+        db.session.execute(upsert, [_row(key, values) for key, values in stats.items()])
+        return
+
+    existing = _existing_buckets(stats)
+    updates, inserts = [], []
+    for key, values in stats.items():
+        if key in existing:
+            row = {'d_' + attr: value for attr, value in zip(_FIELDS, values)}
+            row['k_runner_id'], row['k_period'], row['k_bucket'] = key
+            updates.append(row)
+        else:
+            inserts.append(_row(key, values))
+
+    table = RunStats.__table__
+    if updates:
+        stmt = table.update().where(and_(table.c.runner_id == bindparam('k_runner_id'),
+                                         table.c.period == bindparam('k_period'),
+                                         table.c.bucket == bindparam('k_bucket')))
+        stmt = stmt.values({attr: table.c[attr] + bindparam('d_' + attr) for attr in _FIELDS})
+        db.session.execute(stmt, updates)
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+
+
+def rebuild_stats(user_ids=None):
+    """Recomputes from scratch the statistics of the given users, or of everybody.
+
+    Their revision is bumped so that the clients revalidate: the stats
+    view reads it from the database, so every server sees it once it's
+    committed. `invalidate_stats` then drops the versions cached for the
+    other views.
+    """
+    if user_ids is None:
+        groups = [None]
+    else:
+        groups = chunks(user_ids)
+
+    now = datetime.utcnow()
+    for group in groups:
+        old = db.session.query(RunStats)
+        runs = db.session.query(*[getattr(Run, attr) for attr in _SOURCE])
+        runs = runs.filter(Run.start_date.isnot(None))
+        users = db.session.query(User)
+        if group is not None:
+            old = old.filter(RunStats.runner_id.in_(group))
+            runs = runs.filter(Run.runner_id.in_(group))
+            users = users.filter(User.id.in_(group))
+        users.update({User.revision: User.revision + 1, User.updated_at: now},
+                     synchronize_session=False)
+        old.delete(synchronize_session=False)
+        stats = _aggregate(runs.yield_per(1000))
+        if stats:
+            db.session.execute(RunStats.__table__.insert(),
+                               [_row(key, values) for key, values in stats.items()])
+
+
+def invalidate_stats(user_ids=None):
+    """Drops the cached versions of the users whose statistics were rebuilt, or of everybody.
+
+    Only the cache of this process, or a shared one, is reached: the API
+    servers using the memory cache keep theirs until CACHE_TTL.
+    """
+    if user_ids is None:
+        cache.clear()
+    else:
+        cache.invalidate_user(*user_ids)
+
+
+@job('rebuild_stats')
+def rebuild_stats_job(user_ids=None):
+    rebuild_stats(user_ids)
+    db.session.commit()
+    invalidate_stats(user_ids)
+
+
+def get_stats(user_id, period, start=None, end=None):
+    """Returns the statistics of a user for each `period` between `start` and `end`."""
+    q = db.session.query(RunStats).filter(RunStats.runner_id == user_id,
+                                          RunStats.period == period)
+    if start is not None:
+        q = q.filter(RunStats.bucket >= period_start(period, start))
+    if end is not None:
+        q = q.filter(RunStats.bucket <= period_start(period, end))
+    return q.order_by(RunStats.bucket)
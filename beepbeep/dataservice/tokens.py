@@ -0,0 +1,41 @@
+import hashlib
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+from .cache import MemoryCache
+
+
+def _hash(token):
+    return hashlib.sha256(token.encode('utf8')).digest()
+
+
+def load_public_key(path):
+    with open(path, 'rb') as f:
+        return load_pem_public_key(f.read(), backend=default_backend())
+
+
+class TokenCache(MemoryCache):
+    """LRU cache of verified JWT claims, keyed by the token hash.
+
+    An entry lives at most `ttl` seconds and never past the `exp` claim
+    of its token.
+    """
+    def get(self, token):
+        return super(TokenCache, self).get(_hash(token))
+
+    def put(self, token, claims):
+        ttl = self.ttl
+        if 'exp' in claims:
+            ttl = min(ttl, claims['exp'] - self._clock())
+        self.set(_hash(token), claims, ttl)
+
+
+def decode_token(token, pub_key, cache):
+    """Returns the claims of `token`, verifying its signature only on cache misses."""
+    claims = cache.get(token)
+    if claims is None:
+        import jwt
+        claims = jwt.decode(token, pub_key, audience='beepbeep.io')
+        cache.put(token, claims)
+    return claims
@@ -1,4 +1,5 @@
 from .home import home
+from .metrics import metrics
 from .swagger import api
 
-blueprints = [home, api]
+blueprints = [home, metrics, api]
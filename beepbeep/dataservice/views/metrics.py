@@ -0,0 +1,9 @@
+from flask import Blueprint, Response
+from beepbeep.dataservice import metrics as _metrics
+
+metrics = Blueprint('metrics', __name__)
+
+
+@metrics.route('/metrics')
+def render_metrics():
+    return Response(_metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -1,52 +1,72 @@
 import os
 
-from flakon import SwaggerBlueprint, request_utils
-from flask import request, jsonify
+from flakon import request_utils
+from functools import partial
+from flask import request, current_app
 from beepbeep.dataservice.database import db, User, Run, ReportPeriodicity
-from sqlalchemy import and_
+from beepbeep.dataservice.analytics import DEFAULT_PERCENTILES, user_analytics
+from beepbeep.dataservice.changes import log_change, log_user_delete, get_changes, visibility_lag
+from beepbeep.dataservice.cache import cache, user_key, average_key
+from beepbeep.dataservice.encoding import dumps
+from beepbeep.dataservice.ingest import ingest_runs
+from beepbeep.dataservice.jobs import enqueue, job
+from beepbeep.dataservice.stats import PERIODS, get_stats
+from beepbeep.dataservice.remote import http, run_concurrently
+from beepbeep.dataservice.replicas import replicas
+from beepbeep.dataservice.spec import CachedSwaggerBlueprint
+from beepbeep.dataservice.reports import PERIODICITIES, report_window, report_query, report_row_to_json
+from beepbeep.dataservice.queries import get_user, get_run, get_user_totals, get_user_version, email_exists
+from sqlalchemy import and_, or_
 from datetime import datetime
-from .util import bad_response, existing_user
-from requests import RequestException
-from stravalib import client
+from urllib.parse import urlencode
+from .util import (bad_response, existing_user, encode_cursor, decode_cursor, is_true, stream_json_list,
+                   json_response, user_version, cache_user_read, is_conditional, add_validators,
+                   not_modified_response, batch_results, API_DATE, BATCH_MAX_IDS, CHANGES_MAX_LIMIT,
+                   REPORT_MAX_LIMIT, USERS_MAX_PER_PAGE, ANALYTICS_MAX_BINS, ANALYTICS_MAX_PERCENTILES,
+                   ANALYTICS_MAX_WINDOW)
 
 
 HERE = os.path.dirname(__file__)
 YML = os.path.join(HERE, '..', 'static', 'api.yaml')
-api = SwaggerBlueprint('API', __name__, swagger_spec=YML)
+api = CachedSwaggerBlueprint('API', __name__, swagger_spec=YML)
 
 
 @api.operation('addRuns')
 def add_runs():
-    added = 0
-    for user, runs in request.json.items():
-        q = db.session.query(User).filter(User.id == int(user))
-        if q.count() == 0:
-            continue
-        u = q.first()
-        for run in runs:
-            db_run = Run.from_json(run, u.id)
-            q = db.session.query(Run).filter(Run.strava_id == db_run.strava_id)
-            if q.count() > 0:
-                continue
-            u.total_speed += db_run.average_speed
-            u.total_runs += 1
-            db.session.add(db_run)
-            added += 1
-
-    if added > 0:
-        db.session.commit()
-
+    ingest_runs(request.json)
     return "", 204
 
 
 @api.operation('getAverage')
 def get_average_speed(user_id):
-    q = db.session.query(User).filter(User.id == user_id)
-    if q.count() == 0:
+    try:
+        user_id = int(user_id)
+    except ValueError:
         return bad_response(404, 'Error no User with ID ' + user_id)
-    u = q.first()
-    average_speed = u.total_speed / u.total_runs if u.total_runs > 0 else 0
-    return {'average_speed': float('%.2f' % average_speed)}
+    if is_conditional():
+        version = user_version(user_id)
+        if version is None:
+            return bad_response(404, 'Error no User with ID ' + str(user_id))
+        not_modified = not_modified_response(user_id, version, 'average')
+        if not_modified is not None:
+            return not_modified
+
+    key = average_key(user_id)
+    payload = cache.get(key)
+    if payload is None:
+        totals = get_user_totals(user_id)
+        if totals is None:
+            return bad_response(404, 'Error no User with ID ' + str(user_id))
+        total_speed, total_runs, revision, updated_at = totals
+        average_speed = total_speed / total_runs if total_runs > 0 else 0
+        payload = dumps({'average_speed': float('%.2f' % average_speed)})
+        version = revision, updated_at
+        cache_user_read(user_id, version, (key, payload))
+    else:
+        version = user_version(user_id)
+        if version is None:
+            return bad_response(404, 'Error no User with ID ' + str(user_id))
+    return add_validators(json_response(payload), user_id, version, 'average')
 
 
 @api.operation('getRuns')
@@ -56,19 +76,31 @@ def get_runs(user_id):
     max_id = request.args.get('from-id')
     page = request.args.get('page')
     per_page = request.args.get('per_page')
+    cursor = request.args.get('cursor')
 
     if per_page is None:
         per_page = 10
     per_page = int(per_page)
 
-    if page is None:
+    keyset = cursor is not None
+    if keyset:
+        try:
+            cursor = decode_cursor(cursor)
+        except ValueError:
+            return bad_response(400, 'Error, invalid cursor')
+    elif page is None:
         per_page = None
     else:
         page = int(page)
 
     fun = True
-    if not existing_user(user_id):
+    version = user_version(user_id)
+    if version is None:
         return bad_response(404, 'Error no User with ID ' + user_id)
+    variant = 'runs?' + urlencode(sorted(request.args.items(multi=True)))
+    not_modified = not_modified_response(int(user_id), version, variant)
+    if not_modified is not None:
+        return not_modified
     if start_date is not None:
         start_date = datetime.strptime(start_date, '%Y-%m-%dT%H:%M:%SZ')
         fun = and_(fun, start_date <= Run.start_date)
@@ -78,44 +110,267 @@ def get_runs(user_id):
     if max_id is not None:
         fun = and_(fun, Run.id > max_id)
     fun = and_(fun, Run.runner_id == user_id)
-    runs = db.session.query(Run).filter(fun)
+    runs = db.session.query(*Run.json_columns()).filter(fun)
+
+    if keyset:
+        response = json_response(dumps(_runs_keyset_page(runs, cursor, per_page)))
+        return add_validators(response, int(user_id), version, variant)
 
     if page is not None and per_page is not None:
         offset = page * per_page
         runs = runs.offset(offset).limit(per_page)
 
-    return jsonify([run.to_json() for run in runs])
+    if is_true(request.args.get('stream')):
+        response = stream_json_list(runs, Run.row_to_json)
+    else:
+        response = json_response(dumps([Run.row_to_json(run) for run in runs]))
+    return add_validators(response, int(user_id), version, variant)
+
+
+def _runs_keyset_page(runs, cursor, per_page):
+    if cursor is not None:
+        start_date, run_id = cursor
+        runs = runs.filter(or_(Run.start_date > start_date,
+                               and_(Run.start_date == start_date, Run.id > run_id)))
+    runs = runs.order_by(Run.start_date, Run.id).limit(per_page + 1).all()
+    has_more = len(runs) > per_page
+    runs = runs[:per_page]
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_cursor(runs[-1].start_date, runs[-1].id)
+    return {'runs': [Run.row_to_json(run) for run in runs], 'next': next_cursor, 'has_more': has_more}
+
+
+@api.operation('getStats')
+def get_user_stats(user_id):
+    period = request.args.get('period', '').lower()
+    start = request.args.get('from')
+    end = request.args.get('to')
+    if period not in PERIODS:
+        return bad_response(400, 'Error, period must be one of ' + ', '.join(PERIODS))
+    try:
+        if start is not None:
+            start = datetime.strptime(start, API_DATE)
+        if end is not None:
+            end = datetime.strptime(end, API_DATE)
+    except ValueError:
+        return bad_response(400, 'Error, dates must be in the %s format' % API_DATE)
+
+    # read from the database: a rebuild in another process bumps it without reaching our cache
+    try:
+        version = get_user_version(int(user_id))
+    except ValueError:
+        version = None
+    if version is None:
+        return bad_response(404, 'Error no User with ID ' + str(user_id))
+    variant = 'stats?' + urlencode(sorted(request.args.items(multi=True)))
+    not_modified = not_modified_response(int(user_id), version, variant)
+    if not_modified is not None:
+        return not_modified
+
+    stats = [bucket.to_json() for bucket in get_stats(user_id, period, start, end)]
+    return add_validators(json_response(dumps(stats)), int(user_id), version, variant)
+
+
+@api.operation('getAnalytics')
+def get_user_analytics(user_id):
+    try:
+        percentiles = request.args.get('percentiles')
+        if percentiles is None:
+            percentiles = DEFAULT_PERCENTILES
+        else:
+            percentiles = tuple(float(p) for p in percentiles.split(','))
+        bins = int(request.args.get('bins', 10))
+        window = int(request.args.get('window', 7))
+    except ValueError:
+        return bad_response(400, 'Error, percentiles must be a comma separated list of numbers')
+    if not all(0 <= p <= 100 for p in percentiles) or bins < 1 or window < 1:
+        return bad_response(400, 'Error, percentiles must be between 0 and 100, bins and window positive')
+    if (len(percentiles) > ANALYTICS_MAX_PERCENTILES or bins > ANALYTICS_MAX_BINS
+            or window > ANALYTICS_MAX_WINDOW):
+        return bad_response(400, 'Error, at most %d percentiles, %d bins and a window of %d runs' % (
+            ANALYTICS_MAX_PERCENTILES, ANALYTICS_MAX_BINS, ANALYTICS_MAX_WINDOW))
+
+    version = user_version(user_id)
+    if version is None:
+        return bad_response(404, 'Error no User with ID ' + str(user_id))
+    variant = 'analytics?' + urlencode(sorted(request.args.items(multi=True)))
+    not_modified = not_modified_response(int(user_id), version, variant)
+    if not_modified is not None:
+        return not_modified
+
+    res = user_analytics(int(user_id), version, percentiles, bins, window)
+    return add_validators(json_response(dumps(res)), int(user_id), version, variant)
 
 
 @api.operation('getSingleRun')
 def get_single_run(user_id, run_id):
+    run = get_run(user_id, run_id)
+    if run is not None:
+        return run.to_json()
     if not existing_user(user_id):
         return bad_response(404, 'Error, No user with ID ' + str(user_id))
-    q = db.session.query(Run).filter(and_(Run.id == run_id, Run.runner_id == user_id))
-    if q.count() == 0:
-        return bad_response(404, 'Error, No run with ID ' + str(run_id) + ' for User')
-    return q.first().to_json()
+    return bad_response(404, 'Error, No run with ID ' + str(run_id) + ' for User')
 
 
 @api.operation('getUsers')
 def get_users():
-    users = db.session.query(User)
-    page = 0
-    page_size = None
-    if page_size:
-        users = users.limit(page_size)
-    if page != 0:
-        users = users.offset(page * page_size)
-    return {'users': [user.to_json(secure=True) for user in users]}
+    fields = request.args.get('fields')
+    fields = User.SECURE_JSON_FIELDS if fields is None else [f for f in fields.split(',') if f]
+    if not set(fields) <= set(User.SECURE_JSON_FIELDS):
+        return bad_response(400, 'Error, fields must be among ' + ', '.join(User.SECURE_JSON_FIELDS))
+    if 'id' not in fields:
+        # the cursor of the next page
+        fields = ['id'] + list(fields)
+    columns, serialize = User.projection(fields)
+    users = db.session.query(*columns)
+
+    is_active = request.args.get('is_active')
+    if is_active is not None:
+        users = users.filter(User.is_active == is_true(is_active))
+    periodicity = request.args.get('report_periodicity')
+    if periodicity is not None:
+        periodicity = ReportPeriodicity.from_json(periodicity.capitalize())
+        if periodicity is None:
+            return bad_response(400, 'Error, report_periodicity must be one of No, Daily, Weekly, Monthly')
+        users = users.filter(User.report_periodicity == periodicity)
+
+    keyset = 'cursor' in request.args or 'per_page' in request.args
+    try:
+        after = int(request.args['cursor']) if request.args.get('cursor') else None
+        per_page = int(request.args.get('per_page', 100))
+    except ValueError:
+        return bad_response(400, 'Error, cursor and per_page must be integers')
+    if per_page < 1 or per_page > USERS_MAX_PER_PAGE:
+        return bad_response(400, 'Error, per_page must be between 1 and %d' % USERS_MAX_PER_PAGE)
+    if not keyset:
+        if is_true(request.args.get('stream')):
+            return stream_json_list(users, serialize, prefix='{"users": [', suffix=']}')
+        return json_response(dumps({'users': [serialize(user) for user in users]}))
+
+    if after is not None:
+        users = users.filter(User.id > after)
+    users = users.order_by(User.id).limit(per_page + 1)
+    if is_true(request.args.get('stream')):
+        def suffix(last, has_more):
+            return '],"next":%s,"has_more":%s}' % (dumps(last.id if has_more else None), dumps(has_more))
+        return stream_json_list(users, serialize, prefix='{"users": [', suffix=suffix, limit=per_page)
+    users = users.all()
+    has_more = len(users) > per_page
+    users = users[:per_page]
+    return json_response(dumps({'users': [serialize(user) for user in users],
+                                'next': users[-1].id if has_more else None,
+                                'has_more': has_more}))
 
 
 @api.operation('getSingleUser')
 def get_single_user(user_id):
     secure = request.args.get('secure', False)
-    q = db.session.query(User).filter(User.id == user_id)
-    if q.count() == 0:
-        return bad_response(404, 'No user with ID ' + str(user_id))
-    return q.first().to_json(secure=secure)
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return bad_response(404, 'No user with ID ' + user_id)
+    variant = 'secure' if secure else 'public'
+    if is_conditional():
+        version = user_version(user_id)
+        if version is None:
+            return bad_response(404, 'No user with ID ' + str(user_id))
+        not_modified = not_modified_response(user_id, version, variant)
+        if not_modified is not None:
+            return not_modified
+
+    key = user_key(user_id, secure)
+    payload = cache.get(key)
+    if payload is None:
+        u = get_user(user_id)
+        if u is None:
+            return bad_response(404, 'No user with ID ' + str(user_id))
+        payload = dumps(u.to_json(secure=secure))
+        version = u.revision, u.updated_at
+        cache_user_read(user_id, version, (key, payload))
+    else:
+        version = user_version(user_id)
+        if version is None:
+            return bad_response(404, 'No user with ID ' + str(user_id))
+    return add_validators(json_response(payload), user_id, version, variant)
+
+
+@api.operation('getChanges')
+def get_changes_feed():
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return bad_response(400, 'Error, since and limit must be integers')
+    if limit < 1 or limit > CHANGES_MAX_LIMIT:
+        return bad_response(400, 'Error, limit must be between 1 and %d' % CHANGES_MAX_LIMIT)
+    lag = visibility_lag(current_app.config)
+    changes = [change.to_json() for change in get_changes(since, limit + 1, lag)]
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    next_seq = changes[-1]['seq'] if changes else since
+    return json_response(dumps({'changes': changes, 'next': next_seq, 'has_more': has_more}))
+
+
+@api.operation('getReportBatch')
+def get_report_batch():
+    periodicity = ReportPeriodicity.from_json(request.args.get('periodicity', '').capitalize())
+    if periodicity not in PERIODICITIES:
+        return bad_response(400, 'Error, periodicity must be one of Daily, Weekly, Monthly')
+    start, end = report_window(periodicity)
+    try:
+        start = datetime.strptime(request.args['from'], API_DATE) if 'from' in request.args else start
+        end = datetime.strptime(request.args['to'], API_DATE) if 'to' in request.args else end
+        after = int(request.args['cursor']) if request.args.get('cursor') else None
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return bad_response(400, 'Error, dates must be in the %s format, cursor and limit integers'
+                            % API_DATE)
+    if limit < 1 or limit > REPORT_MAX_LIMIT:
+        return bad_response(400, 'Error, limit must be between 1 and %d' % REPORT_MAX_LIMIT)
+    if start >= end:
+        return bad_response(400, 'Error, the window must end after it starts')
+
+    users = report_query(periodicity, start, end, after).limit(limit + 1)
+    report = {'periodicity': ReportPeriodicity.to_json(periodicity),
+              'from': start.strftime(API_DATE), 'to': end.strftime(API_DATE)}
+    if is_true(request.args.get('stream')):
+        def suffix(last, has_more):
+            return '],"next":%s,"has_more":%s}' % (dumps(last[0] if has_more else None), dumps(has_more))
+        return stream_json_list(users, report_row_to_json, prefix=dumps(report)[:-1] + ',"users":[',
+                                suffix=suffix, limit=limit)
+
+    users = users.all()
+    has_more = len(users) > limit
+    users = users[:limit]
+    report['users'] = [report_row_to_json(user) for user in users]
+    report['next'] = users[-1][0] if has_more else None
+    report['has_more'] = has_more
+    return json_response(dumps(report))
+
+
+@api.operation('batchGetUsers')
+def batch_get_users():
+    ids = request.json['ids']
+    secure = request.json.get('secure', False)
+    if len(ids) > BATCH_MAX_IDS:
+        return bad_response(400, 'Error, at most %d ids can be requested at once' % BATCH_MAX_IDS)
+    q = db.session.query(*User.json_columns(secure=secure)).filter(User.id.in_(set(ids)))
+    users = {user.id: User.row_to_json(user, secure=secure) for user in q}
+    return json_response(dumps({'users': batch_results(ids, users, 'user')}))
+
+
+@api.operation('batchGetRuns')
+def batch_get_runs():
+    ids = request.json['ids']
+    user_id = request.json.get('user_id')
+    if len(ids) > BATCH_MAX_IDS:
+        return bad_response(400, 'Error, at most %d ids can be requested at once' % BATCH_MAX_IDS)
+    q = db.session.query(*Run.json_columns()).filter(Run.id.in_(set(ids)))
+    if user_id is not None:
+        q = q.filter(Run.runner_id == user_id)
+    runs = {run.id: Run.row_to_json(run) for run in q}
+    return json_response(dumps({'runs': batch_results(ids, runs, 'run')}))
 
 
 @api.operation('addUser')
@@ -124,7 +379,10 @@ def add_single_user():
     if existing_user(u.id, u.email):
         return bad_response(400, 'Error, exists already an user with the email: ' + u.email)
     db.session.add(u)
+    db.session.flush()
+    log_change('user', u.id, u.id, 'insert')
     db.session.commit()
+    replicas.wrote(u.id)
     return "", 204
 
 
@@ -134,38 +392,74 @@ def update_single_user(user_id):
     u = User.from_json(request.json)
     if user_id != u.id:
         return bad_response(400, 'user_id mismatch: user_id in path: ' + str(user_id) + ', in json: ' + str(u.id))
-    q = db.session.query(User).filter(User.id == user_id)
-    if q.count() == 0:
+    us = get_user(user_id)
+    if us is None:
         return bad_response(404, 'No user with  ID ' + str(user_id))
-    us = q.first()
     if us.email != u.email:
-        q = db.session.query(User).filter(User.email == u.email)
-        if q.count() > 0:
+        if email_exists(u.email):
             return bad_response(400, 'Trying to update the email of the user with: ' + u.email + 'but another user '
                                                                                                  'already has that '
                  
                                                                                                  'email')
     for attr in request.json:
         setattr(us, attr, request.json[attr])
+    us.revision = User.revision + 1
+    us.updated_at = datetime.utcnow()
     print(us)
+    log_change('user', user_id, user_id, 'update')
     db.session.commit()
+    cache.invalidate_user(user_id)
+    replicas.wrote(user_id)
     return "", 204
 
 
 @api.operation('deleteSingleUser')
 def delete_single_user(user_id):
-    q = db.session.query(User).filter(User.id == user_id)
-    if q.count() == 0:
+    u = get_user(user_id)
+    if u is None:
         return bad_response(404, 'No user with ID ' + str(user_id))
-    u = q.first()
-    try:
-        request_utils.delete_request_retry(request_utils.challenges_endpoint(u.id))
-        request_utils.delete_request_retry(request_utils.objectives_endpoint(u.id))
-    except RequestException:
-        return bad_response(400, 'Error removing the user')
-    if u.strava_token is not None:
-        c = client.Client(access_token=u.strava_token)
-        c.deauthorize()
-    db.session.delete(q.first())
+    cleanup = [(delete_challenges, {'user_id': u.id}),
+               (delete_objectives, {'user_id': u.id})]
+
+    config = current_app.config
+    if config.get('DELETE_CLEANUP', 'sync') == 'outbox':
+        # the other services are cleaned up by the job worker once the user is gone
+        for func, payload in cleanup:
+            enqueue(func.__name__, **payload)
+        if u.strava_token is not None:
+            enqueue('strava_deauthorize', strava_token=u.strava_token)
+    else:
+        calls = [(partial(func, **payload), ()) for func, payload in cleanup]
+        errors = run_concurrently(calls, float(config.get('REMOTE_CALL_TIMEOUT', 10)))
+        if any(error is not None for error in errors):
+            return bad_response(400, 'Error removing the user')
+        # the token is revoked only once the user is surely going away
+        if u.strava_token is not None:
+            try:
+                strava_deauthorize(u.strava_token)
+            except Exception:
+                enqueue('strava_deauthorize', strava_token=u.strava_token)
+    log_user_delete(u.id)
+    db.session.delete(u)
     db.session.commit()
+    cache.invalidate_user(u.id)
+    replicas.wrote(u.id)
     return "", 204
+
+
+@job('delete_challenges')
+def delete_challenges(user_id):
+    http.delete(request_utils.challenges_endpoint(user_id))
+
+
+@job('delete_objectives')
+def delete_objectives(user_id):
+    http.delete(request_utils.objectives_endpoint(user_id))
+
+
+@job('strava_deauthorize')
+def strava_deauthorize(strava_token):
+    # stravalib takes a second to import and only a few deletions need it
+    from stravalib import client
+    client.Client(access_token=strava_token, requests_session=http.client_session).deauthorize()
+
@@ -1,18 +1,205 @@
-from flask import jsonify
-from beepbeep.dataservice.database import db, User
+import base64
+import binascii
+import hashlib
+from datetime import datetime
+from flask import g, jsonify, request, Response, stream_with_context
+from beepbeep.dataservice.cache import cache, version_key
+from beepbeep.dataservice.compression import CODINGS
+from beepbeep.dataservice.database import db
+from beepbeep.dataservice.encoding import dumps
+from beepbeep.dataservice.queries import user_exists, email_exists, get_user_version
+
+
+_CURSOR_DATE = '%Y-%m-%d %H:%M:%S.%f'
+# the dates in the query parameters
+API_DATE = '%Y-%m-%dT%H:%M:%SZ'
+STREAM_BATCH = 500
+BATCH_MAX_IDS = 100
+CHANGES_MAX_LIMIT = 1000
+REPORT_MAX_LIMIT = 1000
+USERS_MAX_PER_PAGE = 1000
+ANALYTICS_MAX_BINS = 100
+ANALYTICS_MAX_PERCENTILES = 20
+ANALYTICS_MAX_WINDOW = 365
 
 
 def bad_response(code, message):
     return jsonify({'response-code': code, 'message': message}), code
 
 
+def json_response(payload, code=200):
+    """Returns an already serialized JSON payload."""
+    return Response(payload, status=code, mimetype='application/json')
+
+
+def batch_results(ids, found, name):
+    """Returns, in the order of `ids`, the entries of a batch get response."""
+    res = []
+    for id_ in ids:
+        if id_ in found:
+            res.append({'id': id_, 'found': True, name: found[id_]})
+        else:
+            res.append({'id': id_, 'found': False})
+    return res
+
+
 def existing_user(user_id=None, email=None):
     if user_id is not None:
-        q = db.session.query(User).filter(User.id == user_id)
-        return q.count() > 0
+        return user_exists(user_id)
     elif email is not None:
-        q = db.session.query(User).filter(User.email == email)
-        return q.count() > 0
+        return email_exists(email)
     else:
         return False
 
+
+def encode_cursor(start_date, run_id):
+    raw = '%s|%d' % (start_date.strftime(_CURSOR_DATE), run_id)
+    return base64.urlsafe_b64encode(raw.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Returns the (start_date, id) key encoded in `cursor`, None for an empty cursor.
+
+    Raises ValueError if the cursor is malformed.
+    """
+    if cursor == '':
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8')
+    except (binascii.Error, UnicodeError):
+        raise ValueError('invalid cursor')
+    start_date, _, run_id = raw.partition('|')
+    return datetime.strptime(start_date, _CURSOR_DATE), int(run_id)
+
+
+def is_true(value):
+    return value is not None and value.lower() in ('1', 'true', 'yes')
+
+
+def stream_json_list(query, serialize, prefix='[', suffix=']', limit=None):
+    """Returns a response streaming the serialized rows of `query` as a JSON array.
+
+    Rows are fetched `STREAM_BATCH` at a time (server side cursors where the
+    driver supports them) and written as soon as a batch is encoded, so the
+    memory used doesn't depend on the number of rows.
+
+    For a page of `limit` rows, `query` returns one more row telling there
+    are more, and `suffix` is a function of the last row written and of
+    whether there are more.
+    """
+    def generate():
+        yield prefix
+        sep = ''
+        batch = []
+        written = 0
+        last = None
+        has_more = False
+        for row in query.yield_per(STREAM_BATCH):
+            if limit is not None and written == limit:
+                has_more = True
+                break
+            batch.append(dumps(serialize(row)))
+            written += 1
+            last = row
+            if len(batch) == STREAM_BATCH:
+                yield sep + ','.join(batch)
+                sep = ','
+                batch = []
+        if batch:
+            yield sep + ','.join(batch)
+        yield suffix(last, has_more) if callable(suffix) else suffix
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def remember_version(user_id, revision, updated_at):
+    updated_at = updated_at.strftime(_CURSOR_DATE) if updated_at is not None else ''
+    cache.set(version_key(user_id), '%d|%s' % (revision, updated_at))
+
+
+def cache_user_read(user_id, version, *entries):
+    """Caches the `(key, payload)` entries and the `version` of a user, all read at that version.
+
+    The version is read again once they are cached: a write committed
+    since the first read may have invalidated the cache before they were
+    set, so they are invalidated again. The writes committing later
+    invalidate them after their commit anyway.
+    """
+    if cache.backend is None:
+        return
+    for key, payload in entries:
+        cache.set(key, payload)
+    remember_version(user_id, *version)
+    # a new transaction, on the primary, sees the writes committed meanwhile
+    db.session.commit()
+    replica = g.pop('db_replica', None)
+    try:
+        current = get_user_version(user_id)
+    finally:
+        if replica is not None:
+            g.db_replica = replica
+    if current is None or tuple(current) != tuple(version):
+        cache.invalidate_user(user_id)
+
+
+def user_version(user_id):
+    """Returns the (revision, updated_at) of a user or None if it doesn't exist.
+
+    The version is read from the cache when possible, so that a
+    conditional request can be answered without touching the database.
+    """
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None
+    version = cache.get(version_key(user_id))
+    if version is not None:
+        revision, _, updated_at = version.partition('|')
+        updated_at = datetime.strptime(updated_at, _CURSOR_DATE) if updated_at else None
+        return int(revision), updated_at
+    version = get_user_version(user_id)
+    if version is not None:
+        cache_user_read(user_id, version)
+    return version
+
+
+def _etag(user_id, version, variant):
+    revision, updated_at = version
+    raw = '%d|%d|%s|%s' % (user_id, revision, updated_at, variant)
+    return hashlib.sha1(raw.encode('utf8')).hexdigest()
+
+
+def is_conditional():
+    return bool(request.if_none_match) or request.if_modified_since is not None
+
+
+def add_validators(response, user_id, version, variant=''):
+    """Sets the ETag and Last-Modified headers of a representation of a user's data.
+
+    `variant` tells apart the different representations depending on
+    the same version, e.g. the query string of a listing.
+    """
+    response.set_etag(_etag(user_id, version, variant))
+    if version[1] is not None:
+        response.last_modified = version[1]
+    return response
+
+
+def not_modified_response(user_id, version, variant=''):
+    """Returns a 304 response if the client has the current representation, None otherwise."""
+    etag = _etag(user_id, version, variant)
+    updated_at = version[1]
+    if request.if_none_match:
+        # the compressed representations have the coding appended to their ETag
+        tags = [etag] + ['%s-%s' % (etag, coding) for coding in CODINGS]
+        fresh = next((tag for tag in tags if request.if_none_match.contains(tag)), None)
+    elif request.if_modified_since is not None and updated_at is not None:
+        # the header has whole seconds: an update later in the same second must not look fresh
+        fresh = updated_at <= request.if_modified_since.replace(tzinfo=None) and etag
+    else:
+        fresh = None
+    if not fresh:
+        return None
+    response = add_validators(Response(status=304), user_id, version, variant)
+    response.set_etag(fresh)
+    return response
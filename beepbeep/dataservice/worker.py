@@ -0,0 +1,45 @@
+import argparse
+import sys
+import signal
+
+from beepbeep.dataservice.app import create_app
+from beepbeep.dataservice.database import db, upgrade_database
+from beepbeep.dataservice.jobs import Worker
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Runs the background jobs of the beepbeep Dataservice')
+
+    parser.add_argument('--config-file', help='Config file',
+                        type=str, default=None)
+    parser.add_argument('--concurrency', help='Jobs run at the same time',
+                        type=int, default=None)
+    parser.add_argument('--interval', help='Seconds between two polls when idle',
+                        type=float, default=None)
+    args = parser.parse_args(args=args)
+
+    app = create_app(args.config_file)
+    config = app.config
+    db.init_app(app)
+    db.app = app
+    db.create_all(app=app)
+    upgrade_database()
+
+    worker = Worker(app,
+                    concurrency=args.concurrency or int(config.get('JOB_CONCURRENCY', 4)),
+                    interval=args.interval or float(config.get('JOB_INTERVAL', 5)),
+                    timeout=float(config.get('JOB_TIMEOUT', 60)),
+                    lease=int(config.get('JOB_LEASE', 300)))
+
+    def _quit(signal, frame):
+        print("Stopping after the running jobs")
+        worker.stop()
+
+    signal.signal(signal.SIGINT, _quit)
+    signal.signal(signal.SIGTERM, _quit)
+    worker.run()
+    print("Bye!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Read/write throughput of concurrent clients with each DB_PROFILE on SQLite.
+
+Writer threads post new runs to /add_runs while reader threads list them
+with /users/<id>/runs, for a fixed time.
+
+    $ python benchmarks/bench_concurrency.py --writers 4 --readers 8 --duration 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import count
+
+from beepbeep.dataservice.app import create_app
+from beepbeep.dataservice.database import db, User, ReportPeriodicity
+from beepbeep.dataservice.engine import PROFILES
+
+
+def populate(users):
+    for i in range(users):
+        db.session.add(User(email='bench%d@example.com' % i, firstname='Bench', lastname='Mark',
+                            age=30, weight=70, max_hr=190, rest_hr=50, vo2max=55,
+                            total_speed=0.0, total_runs=0,
+                            report_periodicity=ReportPeriodicity.Weekly))
+    db.session.commit()
+
+
+def _run(strava_id):
+    start = datetime(2015, 1, 1) + timedelta(minutes=strava_id)
+    return {'title': 'Run %d' % strava_id, 'description': 'Bench', 'strava_id': strava_id,
+            'distance': 5000.0, 'start_date': start.timestamp(), 'elapsed_time': 1500,
+            'average_speed': 3.2, 'average_heartrate': 150.0, 'total_elevation_gain': 12.5}
+
+
+def _client(app, results, deadline, request):
+    client = app.test_client()
+    ok = errors = 0
+    while time.time() < deadline:
+        if request(client).status_code < 400:
+            ok += 1
+        else:
+            errors += 1
+    results.append((ok, errors))
+
+
+def measure(profile, users, writers, readers, batch, duration, directory=None):
+    fd, path = tempfile.mkstemp(suffix='.db', dir=directory)
+    os.close(fd)
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['DB_PROFILE'] = profile
+    # the benchmark is about the database, not the error pages
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    db.init_app(app)
+    try:
+        with app.app_context():
+            db.create_all()
+            populate(users)
+
+        strava_ids = count(1)
+        lock = threading.Lock()
+
+        def write(client):
+            with lock:
+                runs = [_run(next(strava_ids)) for _ in range(batch)]
+            user_id = runs[0]['strava_id'] % users + 1
+            return client.post('/add_runs', json={str(user_id): runs})
+
+        reads = count()
+
+        def read(client):
+            return client.get('/users/%d/runs' % (next(reads) % users + 1))
+
+        deadline = time.time() + duration
+        written, read_ = [], []
+        threads = [threading.Thread(target=_client, args=(app, written, deadline, write))
+                   for _ in range(writers)]
+        threads += [threading.Thread(target=_client, args=(app, read_, deadline, read))
+                    for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with app.app_context():
+            db.get_engine(app).dispose()
+        return [sum(column) for column in zip(*written)], [sum(column) for column in zip(*read_)]
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='DB_PROFILE concurrency benchmark')
+    parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=list(PROFILES))
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--batch', type=int, default=10, help='Runs posted by each write')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--dir', default=None,
+                        help='Where to create the database, fsync is free on a tmpfs')
+    args = parser.parse_args(args=args)
+
+    for profile in args.profiles:
+        (writes, write_errors), (reads, read_errors) = measure(
+            profile, args.users, args.writers, args.readers, args.batch, args.duration, args.dir)
+        print('%-8s writes %8.1f/s (%d errors)  reads %8.1f/s (%d errors)' % (
+            profile, writes / args.duration, write_errors, reads / args.duration, read_errors))
+
+
+if __name__ == '__main__':
+    main()
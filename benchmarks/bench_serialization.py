@@ -0,0 +1,70 @@
+"""Compares the ORM object serialization path with the column projection one.
+
+    $ python benchmarks/bench_serialization.py --runs 50000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+from beepbeep.dataservice.app import create_app
+from beepbeep.dataservice.database import db, User, Run, ReportPeriodicity
+from beepbeep.dataservice.encoding import dumps
+
+
+def populate(runs):
+    user = User(email='bench@example.com', firstname='Bench', lastname='Mark', age=30,
+                weight=70, max_hr=190, rest_hr=50, vo2max=55, total_speed=0.0,
+                total_runs=0, report_periodicity=ReportPeriodicity.Weekly)
+    db.session.add(user)
+    db.session.commit()
+    start = datetime(2015, 1, 1)
+    rows = [{'title': 'Run %d' % i, 'description': 'Morning run', 'strava_id': i,
+             'distance': 5000.0 + i % 1000, 'start_date': start + timedelta(hours=i),
+             'elapsed_time': 1500 + i % 600, 'average_speed': 3.2, 'average_heartrate': 150.0,
+             'total_elevation_gain': 12.5, 'runner_id': user.id} for i in range(runs)]
+    db.session.execute(Run.__table__.insert(), rows)
+    db.session.commit()
+    return user.id
+
+
+def orm_path(user_id):
+    runs = db.session.query(Run).filter(Run.runner_id == user_id)
+    res = json.dumps([run.to_json() for run in runs])
+    db.session.expunge_all()
+    return res
+
+
+def projection_path(user_id):
+    runs = db.session.query(*Run.json_columns()).filter(Run.runner_id == user_id)
+    return dumps([Run.row_to_json(run) for run in runs])
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='to_json serialization benchmark')
+    parser.add_argument('--runs', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(args=args)
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    db.init_app(app)
+    try:
+        with app.app_context():
+            db.create_all()
+            user_id = populate(args.runs)
+            assert json.loads(orm_path(user_id)) == json.loads(projection_path(user_id))
+            for name, path_func in (('orm', orm_path), ('projection', projection_path)):
+                best = min(timeit.repeat(lambda: path_func(user_id), number=1, repeat=args.repeat))
+                print('%-10s %8.1f ms  %8.0f runs/s' % (name, best * 1000, args.runs / best))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Import and create_app time of a fresh worker, with a cold and a warm spec cache.
+
+Each sample runs in a new interpreter. The packages slowest to import are
+listed from `python -X importtime`.
+
+    $ python benchmarks/bench_startup.py --repeat 10
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+_SAMPLE = """
+import time
+start = time.perf_counter()
+from beepbeep.dataservice.app import create_app
+imported = time.perf_counter()
+create_app()
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def sample(cache_dir, importtime=False):
+    env = dict(os.environ, BEEPBEEP_SPEC_CACHE=cache_dir)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (_ROOT, env.get('PYTHONPATH'))))
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', _SAMPLE]
+    res = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, universal_newlines=True)
+    imported, created = map(float, res.stdout.split())
+    return imported, created, res.stderr
+
+
+def slowest_imports(importtime, top):
+    modules = []
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        # only the packages, their modules are in the cumulative time
+        if '.' not in name and not name.startswith('_'):
+            modules.append((int(cumulative), name))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Worker startup benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports to list')
+    args = parser.parse_args(args=args)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, warm in (('cold', False), ('warm', True)):
+            samples = []
+            for _ in range(args.repeat):
+                if not warm:
+                    for entry in os.listdir(cache_dir):
+                        os.unlink(os.path.join(cache_dir, entry))
+                samples.append(sample(cache_dir)[:2])
+            imported, created = (min(column) for column in zip(*samples))
+            print('%s cache: import %6.1f ms  create_app %6.1f ms' % (name, imported * 1000,
+                                                                     created * 1000))
+        _, _, importtime = sample(cache_dir, importtime=True)
+
+    print('\nslowest imports:')
+    for cumulative, name in slowest_imports(importtime, args.top):
+        print('%8.1f ms  %s' % (cumulative / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
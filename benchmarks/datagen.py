@@ -0,0 +1,137 @@
+"""Synthetic dataset generator for the benchmarks.
+
+Builds users with plausible physiology and their runs: the number of runs
+per user is long tailed (a few users run every day, most do not), the
+distances are log-normal around 7 km, the pace depends on the user's
+VO2max and the heartrate sits between the resting and the max one, with
+about 15% of the runs recorded without a heartrate monitor.
+
+    $ python benchmarks/datagen.py --users 5000 --runs 2000000 --db /tmp/bench.db
+"""
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import bindparam
+
+from beepbeep.dataservice.app import create_app
+from beepbeep.dataservice.database import db, User, Run, ReportPeriodicity
+from beepbeep.dataservice.stats import rebuild_stats
+
+
+EPOCH = datetime(2016, 1, 1)
+PERIODICITIES = (ReportPeriodicity.No, ReportPeriodicity.Daily,
+                 ReportPeriodicity.Weekly, ReportPeriodicity.Monthly)
+_TITLES = ('Morning Run', 'Lunch Run', 'Afternoon Run', 'Evening Run', 'Night Run')
+
+
+def user_rows(rng, count, first_id=1):
+    ages = np.clip(rng.normal(36, 11, count), 16, 80).round()
+    weights = np.clip(rng.normal(70, 11, count), 45, 130).round(1)
+    max_hrs = np.clip(220 - ages + rng.normal(0, 7, count), 150, 215).round()
+    rest_hrs = np.clip(rng.normal(60, 8, count), 38, 90).round()
+    vo2maxs = np.clip(rng.normal(46, 8, count), 25, 80).round(2)
+    periodicities = rng.choice(len(PERIODICITIES), count, p=(0.55, 0.05, 0.3, 0.1))
+    active = rng.random(count) > 0.03
+    return [{'id': first_id + i, 'email': 'user%d@example.com' % (first_id + i),
+             'firstname': 'User', 'lastname': str(first_id + i), 'age': int(ages[i]),
+             'weight': float(weights[i]), 'max_hr': int(max_hrs[i]), 'rest_hr': int(rest_hrs[i]),
+             'vo2max': float(vo2maxs[i]), 'is_active': bool(active[i]), 'total_speed': 0.0,
+             'total_runs': 0, 'report_periodicity': PERIODICITIES[periodicities[i]],
+             'revision': 0, 'updated_at': EPOCH}
+            for i in range(count)]
+
+
+def runs_per_user(rng, users, runs):
+    """Splits `runs` among `users` with a long tailed distribution."""
+    weights = rng.lognormal(0, 1.2, users)
+    counts = np.floor(weights / weights.sum() * runs).astype(int)
+    # hands out what the rounding left to the most active users
+    counts[np.argsort(-weights)[:runs - counts.sum()]] += 1
+    return counts
+
+
+def run_rows(rng, user, count, first_strava_id, days=3 * 365):
+    """Returns `count` runs of `user` (a row of `user_rows`), oldest first."""
+    offsets = np.sort(rng.random(count)) * days * 86400
+    distances = np.clip(rng.lognormal(np.log(7000), 0.45, count), 800, 60000).round(1)
+    # faster runners on the shorter distances
+    speeds = user['vo2max'] / 16.0 * (distances / 7000) ** -0.07 * rng.normal(1, 0.06, count)
+    speeds = np.clip(speeds, 1.5, 6.5).round(3)
+    elapsed = (distances / speeds).round().astype(int)
+    effort = np.clip(rng.normal(0.78, 0.06, count), 0.55, 0.97)
+    heartrates = (user['rest_hr'] + effort * (user['max_hr'] - user['rest_hr'])).round(1)
+    heartrates[rng.random(count) < 0.15] = 0.0
+    elevations = rng.exponential(40, count).round(1)
+    titles = rng.integers(len(_TITLES), size=count)
+    return [{'strava_id': first_strava_id + i, 'runner_id': user['id'],
+             'title': _TITLES[titles[i]], 'description': 'Synthetic run',
+             'start_date': EPOCH + timedelta(seconds=float(offsets[i])),
+             'distance': float(distances[i]), 'elapsed_time': int(elapsed[i]),
+             'average_speed': float(speeds[i]), 'average_heartrate': float(heartrates[i]),
+             'total_elevation_gain': float(elevations[i])}
+            for i in range(count)]
+
+
+def generate(users, runs, seed=0, stats=False, chunk=20000):
+    """Adds `users` users and `runs` runs among them to the database of the app in context.
+
+    The user totals are kept consistent with the runs, and with `stats`
+    the per-period statistics are built as well. Returns the ids of the
+    users, most active first.
+    """
+    rng = np.random.default_rng(seed)
+    first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    strava_id = (db.session.query(db.func.max(Run.strava_id)).scalar() or 0) + 1
+    rows = user_rows(rng, users, first_id)
+    counts = runs_per_user(rng, users, runs)
+
+    db.session.execute(User.__table__.insert(), rows)
+    pending, totals = [], []
+    for user, count in zip(rows, counts):
+        if count == 0:
+            continue
+        user_runs = run_rows(rng, user, int(count), strava_id)
+        strava_id += int(count)
+        totals.append({'k_id': user['id'], 'd_total_runs': int(count),
+                       'd_total_speed': float(sum(run['average_speed'] for run in user_runs))})
+        pending.extend(user_runs)
+        if len(pending) >= chunk:
+            db.session.execute(Run.__table__.insert(), pending)
+            pending = []
+    if pending:
+        db.session.execute(Run.__table__.insert(), pending)
+    table = User.__table__
+    if totals:
+        stmt = table.update().where(table.c.id == bindparam('k_id'))
+        db.session.execute(stmt.values(total_runs=bindparam('d_total_runs'),
+                                       total_speed=bindparam('d_total_speed')), totals)
+    if stats:
+        rebuild_stats([user['id'] for user in rows])
+    db.session.commit()
+    return [rows[i]['id'] for i in np.argsort(-counts, kind='stable')]
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Synthetic dataset generator')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--runs', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stats', action='store_true', help='Build the per-period statistics too')
+    parser.add_argument('--db', default='/tmp/beepbeep.dataservice.bench.db')
+    args = parser.parse_args(args=args)
+
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + args.db
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        start = time.time()
+        generate(args.users, args.runs, args.seed, args.stats)
+        print('%d users and %d runs in %.1fs' % (args.users, args.runs, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
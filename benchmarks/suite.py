@@ -0,0 +1,304 @@
+"""Benchmark suite writing a JSON report that later runs can be compared with.
+
+Generates a synthetic dataset (see datagen.py), then runs:
+
+- microbenchmarks of the User and Run to_json/from_json paths,
+- the /add_runs ingest and the getRuns pagination, offset and keyset,
+- an in-process load test: client threads on the Flask test client
+  sending a weighted mix of the API operations for a fixed time.
+
+    $ python benchmarks/suite.py --users 2000 --runs 200000 --output base.json
+    $ python benchmarks/suite.py --users 2000 --runs 200000 --baseline base.json --threshold 0.15
+
+With --baseline the exit status is 1 when any result is worse than the
+baseline by more than --threshold (a fraction). Only the reports made
+with the same parameters on the same machine are comparable.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from datetime import datetime, timedelta
+from itertools import count
+
+import numpy as np
+
+# runs from any directory, without installing the package
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(_HERE, '..'), _HERE]
+
+from beepbeep.dataservice import __version__  # NOQA
+from beepbeep.dataservice.app import create_app  # NOQA
+from beepbeep.dataservice.cache import cache  # NOQA
+from beepbeep.dataservice.database import db, User, Run  # NOQA
+from datagen import generate  # NOQA
+
+HIGHER, LOWER = 'higher', 'lower'
+
+
+def result(value, unit, better=HIGHER):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def best_rate(func, number, repeat):
+    """Returns the best rate of `func` calls per second over `repeat` rounds of `number` calls."""
+    return number / min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def _api_run(strava_id, when):
+    return {'title': 'Bench run', 'description': 'Posted by the benchmark', 'strava_id': strava_id,
+            'distance': 7200.0, 'start_date': when.timestamp(), 'elapsed_time': 2400,
+            'average_speed': 3.0, 'average_heartrate': 152.0, 'total_elevation_gain': 35.0}
+
+
+class Bench(object):
+    def __init__(self, app, users, repeat, batch):
+        self.app = app
+        self.users = users
+        self.repeat = repeat
+        self.batch = batch
+        self.client = app.test_client()
+        max_strava_id = db.session.query(db.func.max(Run.strava_id)).scalar() or 0
+        self.strava_ids = count(max_strava_id + 1)
+        self._lock = threading.Lock()
+
+    def new_runs(self, count_):
+        when = datetime(2019, 1, 1)
+        with self._lock:
+            return [_api_run(next(self.strava_ids), when + timedelta(minutes=i)) for i in range(count_)]
+
+    def serialization(self):
+        user = db.session.query(User).get(self.users[0])
+        runs = db.session.query(Run).filter(Run.runner_id == user.id).limit(1000).all()
+        run_rows = db.session.query(*Run.json_columns()).filter(Run.runner_id == user.id).limit(1000).all()
+        user_json = user.to_json(secure=True)
+        user_json.pop('id')
+        api_runs = [dict(run.to_json(), start_date=run.start_date.timestamp()) for run in runs]
+        db.session.expunge_all()
+
+        def runs_from_json():
+            for run in api_runs:
+                Run.from_json(run, 1)
+
+        def runs_row_from_json():
+            for run in api_runs:
+                Run.row_from_json(run, 1)
+
+        res = {
+            'user.to_json': result(best_rate(lambda: user.to_json(), 2000, self.repeat), 'users/s'),
+            'user.from_json': result(best_rate(lambda: User.from_json(user_json), 2000, self.repeat),
+                                     'users/s'),
+            'run.to_json': result(len(runs) * best_rate(lambda: [run.to_json() for run in runs],
+                                                        20, self.repeat), 'runs/s'),
+            'run.row_to_json': result(len(runs) * best_rate(lambda: [Run.row_to_json(r) for r in run_rows],
+                                                            20, self.repeat), 'runs/s'),
+            'run.from_json': result(len(runs) * best_rate(runs_from_json, 20, self.repeat), 'runs/s'),
+            'run.row_from_json': result(len(runs) * best_rate(runs_row_from_json, 20, self.repeat),
+                                        'runs/s'),
+        }
+        return res
+
+    def ingest(self, rounds=20):
+        timings = []
+        for i in range(rounds):
+            user_id = self.users[i % len(self.users)]
+            body = {str(user_id): self.new_runs(self.batch)}
+            start = time.perf_counter()
+            assert self.client.post('/add_runs', json=body).status_code == 204
+            timings.append(time.perf_counter() - start)
+        return {'add_runs': result(self.batch / float(np.median(timings)), 'runs/s')}
+
+    def pagination(self, per_page=100):
+        user_id = self.users[0]
+        total = db.session.query(Run).filter(Run.runner_id == user_id).count()
+        pages = max(total // per_page, 1)
+
+        def keyset():
+            url = '/users/%d/runs?per_page=%d&cursor=' % (user_id, per_page)
+            body = self.client.get(url).json
+            while body['has_more']:
+                body = self.client.get(url + body['next']).json
+
+        def offset():
+            for page in range(pages):
+                self.client.get('/users/%d/runs?per_page=%d&page=%d' % (user_id, per_page, page))
+
+        def deep_page():
+            self.client.get('/users/%d/runs?per_page=%d&page=%d' % (user_id, per_page, pages - 1))
+
+        return {'get_runs.keyset': result(pages * best_rate(keyset, 1, self.repeat), 'pages/s'),
+                'get_runs.offset': result(pages * best_rate(offset, 1, self.repeat), 'pages/s'),
+                'get_runs.last_page': result(best_rate(deep_page, 20, self.repeat), 'pages/s'),
+                'get_runs.all': result(best_rate(lambda: self.client.get('/users/%d/runs' % user_id),
+                                                 1, self.repeat) * total, 'runs/s')}
+
+    def load(self, clients, duration, seed=0):
+        users = self.users
+        hot = users[:max(len(users) // 10, 1)]
+        operations = [
+            ('getSingleUser', 30, lambda c, r: c.get('/users/%d' % r.choice(users))),
+            ('getAverage', 15, lambda c, r: c.get('/users/%d/average' % r.choice(users))),
+            ('getRuns', 25, lambda c, r: c.get('/users/%d/runs?per_page=50&cursor=' % r.choice(hot))),
+            ('getStats', 10, lambda c, r: c.get('/users/%d/stats?period=monthly' % r.choice(hot))),
+            ('getUsers', 5, lambda c, r: c.get('/users?per_page=100&is_active=true')),
+            ('addRuns', 15, lambda c, r: c.post('/add_runs', json={
+                str(r.choice(users)): self.new_runs(self.batch)})),
+        ]
+        names = [op[0] for op in operations]
+        weights = [op[1] for op in operations]
+        latencies = {name: [] for name in names}
+        errors = {name: 0 for name in names}
+        deadline = time.time() + duration
+
+        def client_loop(index):
+            rng = random.Random(seed + index)
+            client = self.app.test_client()
+            while time.time() < deadline:
+                i = rng.choices(range(len(operations)), weights)[0]
+                start = time.perf_counter()
+                status = operations[i][2](client, rng).status_code
+                latencies[names[i]].append(time.perf_counter() - start)
+                if status >= 400:
+                    errors[names[i]] += 1
+
+        threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        total = sum(len(values) for values in latencies.values())
+        res = {'load.throughput': result(total / duration, 'requests/s'),
+               'load.errors': result(sum(errors.values()), 'requests', LOWER)}
+        for name, values in latencies.items():
+            if values:
+                p50, p95, p99 = np.percentile(values, (50, 95, 99)) * 1000
+                res['load.%s.p50' % name] = result(p50, 'ms', LOWER)
+                res['load.%s.p95' % name] = result(p95, 'ms', LOWER)
+                res['load.%s.p99' % name] = result(p99, 'ms', LOWER)
+        return res
+
+
+def compare(baseline, report, threshold):
+    """Returns the (name, old, new, change) of the results worse than `baseline` by more than `threshold`.
+
+    From a baseline of 0 any increase of a lower-is-better result, as the
+    load test errors, is a regression.
+    """
+    regressions = []
+    for name, new in sorted(report['results'].items()):
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        if not old['value']:
+            if new['better'] != LOWER or new['value'] <= 0:
+                continue
+            change = float('-inf')
+        else:
+            change = (new['value'] - old['value']) / old['value']
+            if new['better'] == LOWER:
+                change = -change
+        marker = ''
+        if change < -threshold:
+            regressions.append((name, old['value'], new['value'], change))
+            marker = '  REGRESSION'
+        print('%-28s %12.2f %12.2f %+8.1f%%%s' % (name, old['value'], new['value'], change * 100, marker))
+    return regressions
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=_HERE).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args):
+    fd, path = tempfile.mkstemp(suffix='.db', dir=args.dir)
+    os.close(fd)
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    # the response cache would hide the database and serialization work
+    app.config['CACHE_BACKEND'] = 'none'
+    cache.init_app(app)
+    db.init_app(app)
+    results = {}
+    try:
+        with app.app_context():
+            db.create_all()
+            start = time.time()
+            users = generate(args.users, args.runs, args.seed, stats=True)
+            print('dataset: %d users, %d runs in %.1fs' % (args.users, args.runs, time.time() - start))
+            bench = Bench(app, users, args.repeat, args.batch)
+            for name in args.only or ('serialization', 'pagination', 'ingest', 'load'):
+                start = time.time()
+                if name == 'load':
+                    res = bench.load(args.clients, args.duration, args.seed)
+                else:
+                    res = getattr(bench, name)()
+                results.update(res)
+                print('%s: %.1fs' % (name, time.time() - start))
+            db.session.remove()
+            db.get_engine(app).dispose()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+    params = {attr: getattr(args, attr) for attr in ('users', 'runs', 'seed', 'repeat', 'batch',
+                                                     'clients', 'duration')}
+    return {'meta': {'date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                     'version': __version__, 'revision': _git_revision(),
+                     'python': platform.python_version(), 'machine': platform.platform(),
+                     'cpus': os.cpu_count(), 'params': params},
+            'results': results}
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark and load test suite')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--runs', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--batch', type=int, default=20, help='Runs posted by each /add_runs')
+    parser.add_argument('--clients', type=int, default=8, help='Threads of the load test')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of the load test')
+    parser.add_argument('--only', nargs='+', choices=('serialization', 'pagination', 'ingest', 'load'))
+    parser.add_argument('--dir', default=None, help='Where to create the database')
+    parser.add_argument('--output', help='Where to write the JSON report')
+    parser.add_argument('--baseline', help='JSON report to compare the results with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Tolerated slowdown from the baseline, as a fraction')
+    args = parser.parse_args(args=args)
+
+    report = run_suite(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        for name, res in sorted(report['results'].items()):
+            print('%-28s %12.2f %s' % (name, res['value'], res['unit']))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta']['params'] != report['meta']['params']:
+            print('warning: the baseline was made with other parameters', file=sys.stderr)
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print('%d results regressed by more than %g%%' % (len(regressions), args.threshold * 100))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
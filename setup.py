@@ -10,4 +10,6 @@ setup(name='beepbeep-data',
       entry_points="""
       [console_scripts]
       beepbeep-dataservice = beepbeep.dataservice.run:main
+      beepbeep-dataservice-rebuild-stats = beepbeep.dataservice.rebuild:main
+      beepbeep-dataservice-worker = beepbeep.dataservice.worker:main
       """)
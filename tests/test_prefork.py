@@ -0,0 +1,98 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+from beepbeep.dataservice.prefork import PooledWSGIServer
+
+
+_SETTINGS = os.path.join(os.path.dirname(__file__), '..', 'beepbeep', 'dataservice', 'settings.ini')
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _children(pid):
+    res = subprocess.run(['ps', '--ppid', str(pid), '-o', 'pid='], stdout=subprocess.PIPE)
+    return set(res.stdout.split())
+
+
+def _wait_for(url):
+    for _ in range(100):
+        try:
+            return requests.get(url)
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise AssertionError('server not started')
+
+
+def test_pooled_server_accept():
+    def app(environ, start_response):
+        time.sleep(0.3)
+        start_response('200 OK', [])
+        return [b'ok']
+
+    server = PooledWSGIServer('127.0.0.1', 0, app, threads=1)
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    clients = [threading.Thread(target=requests.get, args=(url,)) for _ in range(2)]
+    for client in clients:
+        client.start()
+    try:
+        server.handle_request()
+        # the second connection waits in the backlog for the thread
+        start = time.time()
+        server.handle_request()
+        assert time.time() - start > 0.2
+        assert server.handled == 2
+    finally:
+        for client in clients:
+            client.join()
+        server.close()
+
+
+def test_prefork(tmpdir):
+    with open(_SETTINGS) as f:
+        settings = f.read().replace('/tmp/beepbeep.dataservice.db', str(tmpdir.join('db')))
+    config = tmpdir.join('settings.ini')
+    config.write(settings)
+
+    port = _free_port()
+    url = 'http://127.0.0.1:%d/users' % port
+    server = subprocess.Popen([sys.executable, '-m', 'beepbeep.dataservice.run',
+                               '--config-file', str(config), '--host', '127.0.0.1',
+                               '--port', str(port), '--mode', 'prefork', '--workers', '2',
+                               '--threads', '2', '--max-requests', '2'],
+                              stderr=subprocess.PIPE, universal_newlines=True)
+    try:
+        assert _wait_for(url).status_code == 200
+        workers = _children(server.pid)
+        assert len(workers) == 2
+        for _ in range(6):
+            assert requests.get(url, headers={'Connection': 'close'}).status_code == 200
+        # the workers are recycled after two connections
+        time.sleep(0.5)
+        recycled = _children(server.pid)
+        assert len(recycled) == 2 and not recycled & workers
+
+        server.send_signal(signal.SIGHUP)
+        time.sleep(1)
+        reloaded = _children(server.pid)
+        assert len(reloaded) == 2 and not reloaded & recycled
+        assert requests.get(url).status_code == 200
+
+        server.send_signal(signal.SIGTERM)
+        _, errors = server.communicate(timeout=10)
+        assert server.returncode == 0
+        # the memory cache of settings.ini would serve stale users
+        assert 'The memory cache is disabled in prefork mode' in errors
+    finally:
+        if server.poll() is None:
+            server.kill()
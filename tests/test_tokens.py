@@ -0,0 +1,52 @@
+import os
+import time
+import jwt
+from beepbeep.dataservice.app import create_app
+from beepbeep.dataservice.tokens import TokenCache
+
+
+_HERE = os.path.dirname(__file__)
+with open(os.path.join(_HERE, 'privkey.pem')) as f:
+    _KEY = f.read()
+
+
+def create_token(data):
+    return jwt.encode(data, _KEY, algorithm='RS512').decode('ascii')
+
+
+def test_cache_lru_and_ttl():
+    now = [1000.0]
+    cache = TokenCache(size=2, ttl=10, clock=lambda: now[0])
+    cache.put('a', {'exp': 1005})
+    cache.put('b', {})
+    assert cache.get('a') == {'exp': 1005}
+    cache.put('c', {})
+    # b was the least recently used
+    assert cache.get('b') is None
+    assert cache.get('c') == {}
+
+    # never past the exp claim
+    now[0] = 1006
+    assert cache.get('a') is None
+    # nor past the ttl
+    now[0] = 1011
+    assert cache.get('c') is None
+    assert cache.stats() == {'hits': 2, 'misses': 3, 'size': 0, 'max_size': 2}
+
+
+def test_authenticate_uses_cache():
+    app = create_app()
+    app.config['NEED_TOKEN'] = True
+    client = app.test_client()
+    token = create_token({'iss': 'beepbeep', 'aud': 'beepbeep.io',
+                          'exp': int(time.time()) + 60})
+    headers = {'Authorization': 'Bearer ' + token}
+
+    assert client.get('/').status_code == 401
+    assert client.get('/', headers=headers).status_code == 302
+    assert client.get('/', headers=headers).status_code == 302
+    assert app.token_cache.hits == 1
+    assert app.token_cache.misses == 1
+
+    headers = {'Authorization': 'Bearer ' + token[:-4] + 'AAAA'}
+    assert client.get('/', headers=headers).status_code == 401
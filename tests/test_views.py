@@ -1,11 +1,34 @@
-import os, unittest, jwt, pytest
-from datetime import datetime
+import os, json, jsonschema, unittest, jwt, pytest, gzip, zlib, time, threading, requests
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from datetime import datetime, timedelta
+from werkzeug.http import http_date, parse_date
 from beepbeep.dataservice.app import create_app
 from flask_webtest import TestApp as _TestApp
-from beepbeep.dataservice.database import db, User, Run
+from beepbeep.dataservice.database import db, User, Run, RunStats, Job, ReportPeriodicity, upgrade_database
+from beepbeep.dataservice.reports import report_window
+from beepbeep.dataservice.jobs import job, enqueue, claim_jobs, run_jobs
+from beepbeep.dataservice.remote import HTTPPool, RetryBudget, run_concurrently
+from beepbeep.dataservice.engine import profile_options
+from beepbeep.dataservice.replicas import replicas, ReplicaRouter
+from beepbeep.dataservice.cache import cache, RedisCache
+from beepbeep.dataservice import metrics
+from beepbeep.dataservice.views import swagger
+from beepbeep.dataservice.spec import CachedSwaggerBlueprint, cached_spec
+import shutil
+import sqlite3
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from beepbeep.dataservice.stats import rebuild_stats, add_to_stats
+from beepbeep.dataservice import rebuild
+from beepbeep.dataservice.ingest import ingest_runs
+from beepbeep.dataservice.changes import get_changes
 from unittest import mock
 from unittest.mock import patch, Mock
+from flask import Flask, request
 from flask.json import jsonify
+from contextlib import contextmanager
+from sqlalchemy import event, inspect
 
 
 _HERE = os.path.dirname(__file__)
@@ -37,7 +60,13 @@ def app():
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/beepbeep.dataservice_test.db'
 
     yield app
+    if 'sqlalchemy' in app.extensions:
+        # the pooled connections must not outlive the WAL files
+        db.get_engine(app).dispose()
     os.unlink('/tmp/beepbeep.dataservice_test.db')
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists('/tmp/beepbeep.dataservice_test.db' + suffix):
+            os.unlink('/tmp/beepbeep.dataservice_test.db' + suffix)
 
 
 @pytest.fixture
@@ -56,6 +85,20 @@ def client(app):
     yield client
 
 
+@contextmanager
+def count_queries(db_instance):
+    queries = []
+
+    def _count(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    event.listen(db_instance.engine, 'before_cursor_execute', _count)
+    try:
+        yield queries
+    finally:
+        event.remove(db_instance.engine, 'before_cursor_execute', _count)
+
+
 def deletinguser(client, db_instance):
     response=client.delete('/users/1')
     return response
@@ -271,8 +314,8 @@ def test_verifyall(client, db_instance):
     response = add_user33(client, db_instance)
     assert response.status_code == 400
 ################# Test:19 deleting a single user that exist ########################################################## 
-    with mock.patch('beepbeep.dataservice.views.swagger.request_utils')as mocked:
-        mocked.delete_request_retry.return_value.status_code=204
+    with mock.patch('beepbeep.dataservice.views.swagger.http')as mocked:
+        mocked.delete.return_value.status_code=204
         response = deletinguser(client, db_instance)
         #print("HJHJHKGJH {}".format(response))
         #print(db_instance.session.query(User).filter(User.id==1).first().id)
@@ -288,4 +331,898 @@ def test_verifyall(client, db_instance):
 
 
 
-#i created multiple functions just because i wanted to keep the json post requests seperate.
\ No newline at end of file
+def _run(strava_id, average_speed, start_date=1520072989):
+    return {"title": "Run", "description": "Description", "strava_id": strava_id,
+            "distance": 1000, "start_date": start_date, "elapsed_time": 1000,
+            "average_speed": average_speed, "average_heartrate": 0,
+            "total_elevation_gain": 12.2}
+
+
+def test_add_runs_bulk(client, db_instance):
+    add_user(client, db_instance)
+    add_user_again(client, db_instance)
+    response = client.post('/add_runs', json={1: [_run(10, 10.0), _run(11, 20.0), _run(10, 99.0)],
+                                              3: [_run(12, 5.0)],
+                                              42: [_run(13, 1.0)]})
+    assert response.status_code == 204
+    assert db_instance.session.query(Run).count() == 3
+    assert db_instance.session.query(Run).filter(Run.strava_id == 13).count() == 0
+
+    # already stored strava ids are skipped, without scanning the user's history
+    with mock.patch('beepbeep.dataservice.ingest.update_user_totals') as totals, \
+            mock.patch('beepbeep.dataservice.ingest.rebuild_stats') as stats:
+        response = client.post('/add_runs', json={1: [_run(11, 50.0), _run(14, 30.0)]})
+        anonymous = [_run(None, speed) for speed in (10.0, 20.0, 40.0)]
+        with count_queries(db_instance) as queries:
+            assert ingest_runs({1: [_run(14, 30.0)] + anonymous}) == 3
+    assert response.status_code == 204
+    assert not totals.called and not stats.called
+    # the runs without a strava id are inserted in one batch
+    assert len([q for q in queries if q.startswith('INSERT INTO run ')]) == 1
+    db_instance.session.expire_all()
+    user = db_instance.session.query(User).filter(User.id == 1).first()
+    assert user.total_runs == 6
+    assert user.total_speed == 130.0
+    assert db_instance.session.query(RunStats).filter(RunStats.runner_id == 1,
+                                                      RunStats.period == 'daily').one().count == 6
+    # and logged with their own ids
+    runs = db_instance.session.query(Run.id, Run.average_speed).filter(Run.strava_id.is_(None))
+    logged = [c.entity_id for c in get_changes(0, 10) if c.entity == 'run'][-3:]
+    assert sorted(runs.order_by(Run.id)) == list(zip(logged, (10.0, 20.0, 40.0)))
+    response = client.get('/users/1/average')
+    assert response.json['average_speed'] == 21.67
+
+
+def test_get_runs_keyset(client, db_instance):
+    add_user(client, db_instance)
+    client.post('/add_runs', json={1: [_run(i, 10.0, start_date=1520072989 + (i % 3) * 60)
+                                       for i in range(7)]})
+    seen = []
+    response = client.get('/users/1/runs?cursor=&per_page=3')
+    assert response.status_code == 200
+    while True:
+        page = response.json
+        seen.extend((run['start_date'], run['id']) for run in page['runs'])
+        if not page['has_more']:
+            assert page['next'] is None
+            break
+        assert len(page['runs']) == 3
+        # a run added in the middle of the walk doesn't shift the next pages
+        client.post('/add_runs', json={1: [_run(100 + len(seen), 10.0, start_date=1)]})
+        response = client.get('/users/1/runs?per_page=3&cursor=' + page['next'])
+    assert len(seen) == 7
+    assert seen == sorted(seen)
+
+    response = client.get('/users/1/runs?cursor=garbage')
+    assert response.status_code == 400
+
+
+def test_streaming_listings(client, db_instance):
+    add_user(client, db_instance)
+    add_user_again(client, db_instance)
+    client.post('/add_runs', json={1: [_run(i, 10.0) for i in range(7)]})
+
+    with patch('beepbeep.dataservice.views.util.STREAM_BATCH', 3):
+        response = client.get('/users/1/runs?stream=true')
+        assert response.status_code == 200
+        assert response.json == client.get('/users/1/runs').json
+        assert len(response.json) == 7
+
+        response = client.get('/users?stream=1')
+        assert response.status_code == 200
+        assert response.json == client.get('/users').json
+
+
+def test_get_users_pages(client, db_instance):
+    for i in range(1, 8):
+        db_instance.session.add(User(id=i, email='user%d@example.com' % i, strava_token='token',
+                                     is_active=i % 3 != 0,
+                                     report_periodicity=ReportPeriodicity.Weekly if i % 2 else ReportPeriodicity.No))
+    db_instance.session.commit()
+
+    users, cursor = [], ''
+    while cursor is not None:
+        page = client.get('/users?per_page=3&cursor=%s' % cursor).json
+        assert len(page['users']) <= 3 and page['has_more'] == (page['next'] is not None)
+        users.extend(page['users'])
+        cursor = page['next']
+    assert users == client.get('/users').json['users']
+    assert [u['id'] for u in users] == list(range(1, 8))
+
+    # only the requested columns are read
+    with count_queries(db_instance) as queries:
+        page = client.get('/users?fields=email,report_periodicity&per_page=2').json
+    assert page['users'] == [{'id': 1, 'email': 'user1@example.com', 'report_periodicity': 'Weekly'},
+                             {'id': 2, 'email': 'user2@example.com', 'report_periodicity': 'No'}]
+    assert 'strava_token' not in queries[0] and 'LIMIT' in queries[0]
+
+    page = client.get('/users?is_active=true&report_periodicity=weekly&fields=id&per_page=1&cursor=1').json
+    assert page == {'users': [{'id': 5}], 'next': 5, 'has_more': True}
+    assert client.get('/users?is_active=false&fields=id').json == {'users': [{'id': 3}, {'id': 6}]}
+    url = '/users?per_page=2&cursor=2&fields=id,strava_token'
+    assert client.get(url + '&stream=true').json == client.get(url).json
+
+    assert client.get('/users?fields=password').status_code == 400
+    assert client.get('/users?report_periodicity=Yearly').status_code == 400
+    assert client.get('/users?per_page=0').status_code == 400
+
+
+def test_single_lookups_query_count(client, db_instance):
+    add_user(client, db_instance)
+    client.post('/add_runs', json={1: [_run(1, 10.0)]})
+
+    # the users are cached once their version is checked again
+    for url, count in (('/users/1', 2), ('/users/1/average', 2), ('/users/1/runs/1', 1)):
+        with count_queries(db_instance) as queries:
+            response = client.get(url)
+        assert response.status_code == 200
+        assert len(queries) == count, queries
+
+    for url in ('/users/2', '/users/2/average'):
+        with count_queries(db_instance) as queries:
+            response = client.get(url)
+        assert response.status_code == 404
+        assert len(queries) == 1, queries
+
+    with count_queries(db_instance) as queries:
+        response = client.get('/users/1/runs/2')
+    assert response.status_code == 404
+    assert len(queries) == 2, queries
+
+
+def test_read_through_cache(client, db_instance):
+    add_user(client, db_instance)
+    client.post('/add_runs', json={1: [_run(1, 10.0)]})
+    assert client.get('/users/1/average').json['average_speed'] == 10.0
+    assert client.get('/users/1').json['weight'] == 1
+
+    for url in ('/users/1', '/users/1/average'):
+        with count_queries(db_instance) as queries:
+            response = client.get(url)
+        assert response.status_code == 200
+        assert queries == []
+
+    client.post('/add_runs', json={1: [_run(2, 20.0)]})
+    assert client.get('/users/1/average').json['average_speed'] == 15.0
+
+    add_user2(client, db_instance, 1)
+    assert client.get('/users/1').json['weight'] == 2
+
+    with mock.patch('beepbeep.dataservice.views.swagger.http'):
+        assert deletinguser(client, db_instance).status_code == 204
+    assert client.get('/users/1').status_code == 404
+    assert client.get('/users/1/average').status_code == 404
+
+
+def test_read_through_cache_race(client, db_instance):
+    add_user(client, db_instance)
+    get_user = swagger.get_user
+    reader = threading.current_thread()
+
+    def get_user_then_update(user_id):
+        user = get_user(user_id)
+        if threading.current_thread() is reader:
+            # the update commits, and invalidates the cache, before the read is cached
+            writer = threading.Thread(target=add_user2, args=(client, db_instance, 1))
+            writer.start()
+            writer.join()
+        return user
+
+    with mock.patch('beepbeep.dataservice.views.swagger.get_user', get_user_then_update):
+        stale = client.get('/users/1')
+    assert stale.json['weight'] == 1
+
+    # neither the stale body nor its ETag are kept
+    assert client.get('/users/1').json['weight'] == 2
+    assert client.get('/users/1', headers={'If-None-Match': stale.headers['ETag']}).status_code == 200
+
+
+def test_conditional_get(client, db_instance):
+    add_user(client, db_instance)
+    client.post('/add_runs', json={1: [_run(1, 10.0)]})
+
+    for url in ('/users/1', '/users/1/average', '/users/1/runs', '/users/1/runs?cursor='):
+        response = client.get(url)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        with count_queries(db_instance) as queries:
+            response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        assert queries == []
+        # Last-Modified is truncated to the second, the data may have changed since in that second
+        response = client.get(url, headers={'If-Modified-Since': last_modified})
+        assert response.status_code == 200
+        later = http_date(parse_date(last_modified) + timedelta(seconds=1))
+        response = client.get(url, headers={'If-Modified-Since': later})
+        assert response.status_code == 304
+
+    etags = [client.get(url).headers['ETag'] for url in ('/users/1', '/users/1?secure=1', '/users/1/runs')]
+    assert len(set(etags)) == 3
+
+    client.post('/add_runs', json={1: [_run(2, 10.0)]})
+    response = client.get('/users/1/runs', headers={'If-None-Match': etags[2]})
+    assert response.status_code == 200
+    assert len(response.json) == 2
+
+    last_modified = client.get('/users/1').headers['Last-Modified']
+    add_user2(client, db_instance, 1)
+    response = client.get('/users/1', headers={'If-None-Match': etags[0]})
+    assert response.status_code == 200
+    assert response.json['weight'] == 2
+    # updated in the same second as the previous read
+    db_instance.session.query(User).update({User.updated_at: parse_date(last_modified).replace(
+        tzinfo=None, microsecond=500000)})
+    db_instance.session.commit()
+    cache.invalidate_user(1)
+    response = client.get('/users/1', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+
+
+def test_projection_matches_to_json(client, db_instance):
+    add_user(client, db_instance)
+    client.post('/add_runs', json={1: [_run(1, 10.0)]})
+    user = db_instance.session.query(User).first()
+    row = db_instance.session.query(*User.json_columns(secure=True)).first()
+    assert User.row_to_json(row, secure=True) == user.to_json(secure=True)
+    assert user.to_json()['report_periodicity'] == 'No'
+    run = db_instance.session.query(Run).first()
+    row = db_instance.session.query(*Run.json_columns()).first()
+    assert Run.row_to_json(row) == run.to_json()
+    assert client.get('/users/1/runs').json == [run.to_json()]
+
+
+def test_compression(client, db_instance):
+    add_user(client, db_instance)
+    client.post('/add_runs', json={1: [_run(i, 10.0) for i in range(50)]})
+    plain = client.get('/users/1/runs')
+    assert 'Content-Encoding' not in plain.headers
+
+    response = client.get('/users/1/runs', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(response.data) == plain.data
+    etag = response.headers['ETag']
+    response = client.get('/users/1/runs', headers={'If-None-Match': etag, 'Accept-Encoding': 'gzip'})
+    assert response.status_code == 304
+
+    response = client.get('/users/1/runs?stream=1', headers={'Accept-Encoding': 'deflate'})
+    assert response.headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(response.data) == client.get('/users/1/runs?stream=1').data
+
+    # too small to be worth it
+    response = client.get('/users/1', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_period_stats(client, db_instance):
+    add_user(client, db_instance)
+    monday = datetime(2018, 10, 1, 8).timestamp()
+    day = 24 * 3600
+    client.post('/add_runs', json={1: [_run(1, 10.0, monday), _run(2, 20.0, monday + 2 * day),
+                                       _run(3, 30.0, monday + 8 * day)]})
+    response = client.get('/users/1/stats?period=weekly')
+    assert response.status_code == 200
+    assert [(week['count'], week['average_speed']) for week in response.json] == [(2, 15.0), (1, 30.0)]
+    assert response.json[0]['start'] == datetime(2018, 10, 1).timestamp()
+    assert response.json[0]['distance'] == 2000
+
+    # partially duplicated batches and the rebuild give the same totals
+    client.post('/add_runs', json={1: [_run(3, 30.0, monday + 8 * day), _run(4, 40.0, monday + day)]})
+    weekly = client.get('/users/1/stats?period=weekly').json
+    assert [week['count'] for week in weekly] == [3, 1]
+    daily = client.get('/users/1/stats?period=daily&from=2018-10-02T00:00:00Z&to=2018-10-05T00:00:00Z').json
+    assert [day['count'] for day in daily] == [1, 1]
+    monthly = client.get('/users/1/stats?period=monthly').json
+    assert monthly[0]['count'] == 4
+
+    # the rows of an existing bucket are added to it
+    add_to_stats([Run.row_from_json(_run(5, 50.0, monday), 1)])
+    assert client.get('/users/1/stats?period=monthly').json[0]['count'] == 5
+    db_instance.session.rollback()
+
+    before = sorted(tuple(stats.to_json().items()) for stats in db_instance.session.query(RunStats))
+    etag = client.get('/users/1/stats?period=weekly').headers['ETag']
+    # as by the CLI, whose invalidation doesn't reach this process
+    rebuild_stats()
+    db_instance.session.commit()
+    after = sorted(tuple(stats.to_json().items()) for stats in db_instance.session.query(RunStats))
+    assert before == after
+    # the clients holding stats from before the rebuild get them again
+    response = client.get('/users/1/stats?period=weekly', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+    assert client.get('/users/1/stats?period=yearly').status_code == 400
+    assert client.get('/users/2/stats?period=daily').status_code == 404
+    with mock.patch('beepbeep.dataservice.views.swagger.http'):
+        deletinguser(client, db_instance)
+    assert db_instance.session.query(RunStats).count() == 0
+
+
+def test_analytics(client, db_instance):
+    add_user(client, db_instance)
+    speeds = [3.0, 1.0, 2.0, 5.0, 4.0]
+    runs = [_run(i, speed, start_date=1520072989 + i * 3600) for i, speed in enumerate(speeds)]
+    runs[0]['average_heartrate'] = 150
+    client.post('/add_runs', json={1: runs})
+
+    response = client.get('/users/1/analytics?percentiles=0,50,100&bins=2&window=2')
+    assert response.status_code == 200
+    speed = response.json['average_speed']
+    assert speed['count'] == 5
+    assert speed['mean'] == 3.0
+    assert speed['percentiles'] == {'0': 1.0, '50': 3.0, '100': 5.0}
+    assert speed['histogram'] == {'counts': [2, 3], 'edges': [1.0, 3.0, 5.0]}
+    assert speed['rolling_average'] == [2.0, 1.5, 3.5, 4.5]
+    # the runs without heartrate are ignored
+    assert response.json['average_heartrate']['count'] == 1
+
+    with count_queries(db_instance) as queries:
+        client.get('/users/1/analytics?percentiles=0,50,100&bins=2&window=2')
+    assert queries == []
+    client.post('/add_runs', json={1: [_run(10, 10.0, start_date=1520072989 + 10 * 3600)]})
+    response = client.get('/users/1/analytics?percentiles=0,50,100&bins=2&window=2')
+    assert response.json['average_speed']['max'] == 10.0
+
+    assert client.get('/users/1/analytics?percentiles=101').status_code == 400
+    assert client.get('/users/1/analytics?window=a').status_code == 400
+    assert client.get('/users/1/analytics?bins=1000000000').status_code == 400
+    assert client.get('/users/1/analytics?window=366').status_code == 400
+    assert client.get('/users/1/analytics?percentiles=' + ','.join(['50'] * 21)).status_code == 400
+    assert client.get('/users/2/analytics').status_code == 404
+
+
+def test_batch_get(client, db_instance):
+    add_user(client, db_instance)
+    add_user_again(client, db_instance)
+    client.post('/add_runs', json={1: [_run(1, 10.0)], 3: [_run(2, 20.0)]})
+
+    with count_queries(db_instance) as queries:
+        response = client.post('/users:batchGet', json={'ids': [3, 7, 1]})
+    assert response.status_code == 200
+    assert len(queries) == 1
+    users = response.json['users']
+    assert [(user['id'], user['found']) for user in users] == [(3, True), (7, False), (1, True)]
+    assert users[0]['user'] == client.get('/users/3').json
+    assert 'strava_token' not in users[0]['user']
+    response = client.post('/users:batchGet', json={'ids': [1], 'secure': True})
+    assert 'strava_token' in response.json['users'][0]['user']
+
+    response = client.post('/runs:batchGet', json={'ids': [2, 1, 5]})
+    runs = response.json['runs']
+    assert [(run['id'], run['found']) for run in runs] == [(2, True), (1, True), (5, False)]
+    assert runs[1]['run'] == client.get('/users/1/runs/1').json
+    response = client.post('/runs:batchGet', json={'ids': [2, 1], 'user_id': 1})
+    assert [run['found'] for run in response.json['runs']] == [False, True]
+
+    response = client.post('/runs:batchGet', json={'ids': list(range(101))})
+    assert response.status_code == 400
+
+
+def test_changes_feed(client, db_instance):
+    add_user(client, db_instance)
+    client.post('/add_runs', json={1: [_run(1, 10.0), _run(2, 20.0)]})
+    # the duplicated run is not logged twice
+    client.post('/add_runs', json={1: [_run(2, 20.0), _run(3, 30.0)]})
+    # a run stored before the change log existed is not logged when it's sent again
+    db_instance.session.execute(Run.__table__.insert(), Run.row_from_json(_run(9, 10.0), 1))
+    db_instance.session.commit()
+    client.post('/add_runs', json={1: [_run(9, 10.0)]})
+    add_user2(client, db_instance, 1)
+
+    response = client.get('/changes?limit=2')
+    assert response.status_code == 200
+    feed = response.json
+    assert feed['has_more']
+    changes = feed['changes']
+    while feed['has_more']:
+        feed = client.get('/changes?limit=2&since=%d' % feed['next']).json
+        changes.extend(feed['changes'])
+    assert [(c['entity'], c['id'], c['op']) for c in changes] == [
+        ('user', 1, 'insert'), ('run', 1, 'insert'), ('run', 2, 'insert'),
+        ('run', 3, 'insert'), ('user', 1, 'update')]
+    assert [c['seq'] for c in changes] == sorted(c['seq'] for c in changes)
+    # the changes show up once their transaction is surely committed
+    assert get_changes(0, 10, lag=3600).all() == []
+
+    with mock.patch('beepbeep.dataservice.views.swagger.http'):
+        deletinguser(client, db_instance)
+    feed = client.get('/changes?since=%d' % feed['next']).json
+    assert not feed['has_more']
+    assert sorted((c['entity'], c['id'], c['op']) for c in feed['changes']) == [
+        ('run', 1, 'delete'), ('run', 2, 'delete'), ('run', 3, 'delete'), ('run', 4, 'delete'),
+        ('user', 1, 'delete')]
+    assert client.get('/changes?since=%d' % feed['next']).json['changes'] == []
+    assert client.get('/changes?limit=0').status_code == 400
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(_StubHandler, self).setup()
+        self.server.connections += 1
+
+    def do_DELETE(self):
+        self.server.paths.append(self.path)
+        time.sleep(self.server.delay)
+        self.send_response(self.server.statuses.pop(0) if self.server.statuses else 204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class _StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def stub_service():
+    """A local HTTP server answering every DELETE with a 204 after `delay` seconds."""
+    server = _StubServer(('127.0.0.1', 0), _StubHandler)
+    server.paths = []
+    server.statuses = []
+    server.connections = 0
+    server.delay = 0
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@contextmanager
+def remote_services(url):
+    with mock.patch('flakon.request_utils.challenges_endpoint', lambda id: url + '/challenges/%d' % id), \
+            mock.patch('flakon.request_utils.objectives_endpoint', lambda id: url + '/objectives/%d' % id):
+        yield
+
+
+def test_delete_cleanup_concurrent(app, client, db_instance, stub_service):
+    add_user(client, db_instance)
+    stub_service.delay = 0.3
+    with remote_services(stub_service.url):
+        start = time.time()
+        assert deletinguser(client, db_instance).status_code == 204
+        # the two services are called at the same time
+        assert time.time() - start < 0.55
+    assert sorted(stub_service.paths) == ['/challenges/1', '/objectives/1']
+
+    # the user, and its Strava token, are kept if a service does not answer in time
+    add_user(client, db_instance)
+    db_instance.session.query(User).update({User.strava_token: 'token'})
+    db_instance.session.commit()
+    app.config['REMOTE_CALL_TIMEOUT'] = 0.1
+    with remote_services(stub_service.url), \
+            mock.patch('beepbeep.dataservice.views.swagger.strava_deauthorize') as deauthorize:
+        assert deletinguser(client, db_instance).status_code == 400
+        assert not deauthorize.called
+        assert db_instance.session.query(User).count() == 1
+
+        # then revoked once the services are cleaned up, or later by a job
+        app.config['REMOTE_CALL_TIMEOUT'] = 10
+        deauthorize.side_effect = ValueError('Strava is down')
+        assert deletinguser(client, db_instance).status_code == 204
+        deauthorize.assert_called_once_with('token')
+    assert [(j.kind, json.loads(j.payload)) for j in db_instance.session.query(Job)] == [
+        ('strava_deauthorize', {'strava_token': 'token'})]
+
+
+def test_delete_cleanup_outbox(app, client, db_instance, stub_service):
+    add_user(client, db_instance)
+    app.config['DELETE_CLEANUP'] = 'outbox'
+    # nothing listens on the closed port, the user is deleted anyway
+    closed = HTTPServer(('127.0.0.1', 0), _StubHandler)
+    closed.server_close()
+    with remote_services('http://127.0.0.1:%d' % closed.server_address[1]):
+        assert deletinguser(client, db_instance).status_code == 204
+        assert db_instance.session.query(User).count() == 0
+        assert db_instance.session.query(Job).count() == 2
+        assert run_jobs('test', timeout=10) == 2
+
+    jobs = db_instance.session.query(Job).all()
+    assert [(j.status, j.attempts) for j in jobs] == [('pending', 1), ('pending', 1)]
+    assert all(j.run_at > datetime.utcnow() for j in jobs)
+    # nothing is due until the backoff expires
+    with remote_services(stub_service.url):
+        assert run_jobs('test') == 0
+        for j in jobs:
+            j.run_at = datetime(2000, 1, 1)
+        db_instance.session.commit()
+        assert run_jobs('test') == 2
+    assert db_instance.session.query(Job).count() == 0
+    assert sorted(stub_service.paths) == ['/challenges/1', '/objectives/1']
+
+
+def test_report_batch(client, db_instance):
+    for i, periodicity in enumerate(['Weekly', 'Weekly', 'Monthly', 'Weekly', 'Weekly']):
+        db_instance.session.add(User(id=i + 1, email='user%d@example.com' % i, firstname='user',
+                                     lastname=str(i), report_periodicity=ReportPeriodicity(periodicity),
+                                     is_active=i != 3))
+    db_instance.session.commit()
+    day = lambda d: datetime(2018, 3, d).timestamp()
+    client.post('/add_runs', json={1: [_run(1, 2.0, day(5)), _run(2, 4.0, day(11)), _run(3, 8.0, day(12))],
+                                   3: [_run(4, 1.0, day(6))], 4: [_run(5, 1.0, day(6))]})
+
+    url = '/reports?periodicity=weekly&from=2018-03-05T00:00:00Z&to=2018-03-12T00:00:00Z&limit=2'
+    report = client.get(url).json
+    assert (report['periodicity'], report['from'], report['has_more'], report['next']) == (
+        'Weekly', '2018-03-05T00:00:00Z', True, 2)
+    assert [u['id'] for u in report['users']] == [1, 2]
+    assert report['users'][0]['totals'] == {'count': 2, 'distance': 2000.0, 'elapsed_time': 2000,
+                                            'total_elevation_gain': 24.4, 'average_speed': 3.0,
+                                            'average_heartrate': None}
+    assert report['users'][1]['totals']['count'] == 0
+    assert 'strava_token' not in report['users'][0]
+
+    # the inactive user is skipped
+    last = client.get(url + '&cursor=2').json
+    assert ([u['id'] for u in last['users']], last['next'], last['has_more']) == ([5], None, False)
+    for cursor in ('', '&cursor=2'):
+        assert client.get(url + cursor + '&stream=true').json == client.get(url + cursor).json
+
+    with count_queries(db_instance) as queries:
+        client.get(url)
+    assert len(queries) == 1
+
+    assert report_window(ReportPeriodicity.Weekly, datetime(2018, 3, 14, 10)) == (
+        datetime(2018, 3, 5), datetime(2018, 3, 12))
+    assert client.get('/reports?periodicity=No').status_code == 400
+    assert client.get('/reports?periodicity=Daily&from=2018-03-05').status_code == 400
+    assert client.get(url.replace('from=2018-03-05', 'from=2018-03-15')).status_code == 400
+
+
+def test_engine_profile(app, db_instance):
+    # settings.ini uses the tuned profile
+    assert isinstance(db_instance.engine.pool, QueuePool)
+    pragma = lambda name: db_instance.session.execute('PRAGMA ' + name).scalar()
+    assert pragma('journal_mode') == 'wal'
+    assert pragma('synchronous') == 1
+    assert pragma('busy_timeout') == 5000
+    assert pragma('cache_size') == -65536
+
+    options, pragmas = profile_options({'DB_PROFILE': 'tuned'}, make_url('postgresql://db/beepbeep'))
+    assert options['pool_pre_ping'] and options['pool_recycle'] == 1800 and pragmas == ()
+    options, pragmas = profile_options({'DB_PROFILE': 'tuned'}, make_url('sqlite://'))
+    assert options == {} and 'journal_mode' not in dict(pragmas)
+    assert profile_options({'DB_PROFILE': 'default'}, make_url('sqlite:///x.db')) == ({}, ())
+    with pytest.raises(ValueError):
+        profile_options({'DB_PROFILE': 'fast'}, make_url('sqlite:///x.db'))
+
+
+def test_read_replicas(tmpdir):
+    primary, replica = str(tmpdir.join('primary.db')), str(tmpdir.join('replica.db'))
+    with open(os.path.join(_HERE, '..', 'beepbeep', 'dataservice', 'settings.ini')) as f:
+        settings = f.read()
+    settings = settings.replace('/tmp/beepbeep.dataservice.db', primary)
+    # the second replica can't be opened
+    settings = settings.replace('SQLALCHEMY_REPLICA_URIS =', 'SQLALCHEMY_REPLICA_URIS = sqlite:///%s '
+                                'sqlite:///%s/missing/replica.db' % (replica, tmpdir))
+    settings = settings.replace('READ_YOUR_WRITES_WINDOW = 5', 'READ_YOUR_WRITES_WINDOW = 0.2')
+    tmpdir.join('settings.ini').write(settings)
+    app = create_app(str(tmpdir.join('settings.ini')))
+    db.init_app(app)
+    client = app.test_client()
+    with app.app_context():
+        db.create_all()
+        add_user(client, db)
+        db.session.remove()
+        # checkpoints the WAL before the copy
+        db.get_engine(app).dispose()
+    shutil.copy(primary, replica)
+
+    # the replica doesn't get the new runs
+    assert client.post('/add_runs', json={1: [_run(1, 10.0), _run(2, 20.0)]}).status_code == 204
+    assert len(client.get('/users/1/runs').json) == 2
+    time.sleep(0.3)
+    for _ in range(3):
+        assert client.get('/users/1/runs').json == []
+    assert not replicas.replicas[1].healthy
+
+    add_user_again(client, db)
+    assert client.get('/users/3').status_code == 200
+    assert [u['id'] for u in client.get('/users').json['users']] == [1]
+
+
+class _FakeRedis(object):
+    """Keeps the entries in a dict and, as Redis, takes only positive integer TTLs."""
+    def __init__(self):
+        self.entries = {}
+
+    def setex(self, key, ttl, value):
+        if not isinstance(ttl, int) or ttl <= 0:
+            raise ValueError('invalid expire time in setex')
+        self.entries[key] = str(value).encode('utf8')
+
+    def get(self, key):
+        return self.entries.get(key)
+
+
+def test_read_your_writes_redis():
+    fake = _FakeRedis()
+    redis = Mock(**{'StrictRedis.from_url.return_value': fake})
+    with mock.patch.dict('sys.modules', redis=redis):
+        backend = RedisCache('redis://localhost:6379/0')
+    router = ReplicaRouter()
+    router.replicas, router.window = [Mock()], 0.2
+    # the other workers see the writes through the shared cache
+    with mock.patch.object(cache, 'backend', backend):
+        router.wrote(1)
+        assert router.recently_written(1) and not router.recently_written(2)
+    assert fake.entries == {'beepbeep.dataservice:written:1': b'1'}
+
+
+def test_http_pool(stub_service):
+    http = HTTPPool(size=2, retries=2, backoff=0, budget=RetryBudget(ratio=0, minimum=2))
+    url = stub_service.url + '/objectives/1'
+    for _ in range(5):
+        assert http.delete(url).status_code == 204
+    # the connection is kept alive
+    assert stub_service.connections == 1
+
+    # the unavailable service is called again, as long as the budget allows it
+    stub_service.statuses = [503, 503]
+    assert http.delete(url).status_code == 204
+    assert http.stats()['retries'] == 2
+    stub_service.statuses = [503]
+    with pytest.raises(requests.HTTPError):
+        http.delete(url)
+    stats = http.stats()
+    assert stats['budget_exhausted'] == 1 and stats['errors'] == 1
+
+    # the calls beyond the pool size wait for a free connection
+    stub_service.delay = 0.1
+    errors = run_concurrently([(http.delete, (url,))] * 4)
+    assert errors == [None] * 4
+    stats = http.stats()
+    assert stats['saturated'] == 2 and stats['max_in_flight'] == 4
+    assert stats['in_flight'] == 0 and stub_service.connections <= 3
+
+    # each service has its own connections
+    other = url.replace('127.0.0.1', 'localhost')
+    errors = run_concurrently([(http.delete, (url,))] * 2 + [(http.delete, (other,))] * 2)
+    assert errors == [None] * 4
+    assert http.stats()['saturated'] == 2
+
+    # the third-party clients go through the pool
+    stub_service.delay = 0
+    assert http.client_session.delete(url).status_code == 204
+    assert http.stats()['requests'] == 18
+
+
+_calls = []
+
+
+@job('test_job')
+def _test_job(value, fail=False, seconds=0):
+    time.sleep(seconds)
+    _calls.append(value)
+    if fail:
+        raise ValueError(value)
+
+
+def test_jobs(client, db_instance):
+    del _calls[:]
+    enqueue('test_job', value=1)
+    enqueue('test_job', value=2, fail=True, max_attempts=2)
+    enqueue('test_job', value=3, delay=3600)
+    db_instance.session.commit()
+    with pytest.raises(ValueError):
+        enqueue('missing_job')
+
+    # the claimed jobs are not given to other workers
+    assert [j.id for j in claim_jobs('first', 1)] == [1]
+    assert run_jobs('second', limit=10) == 1
+    assert _calls == [2]
+    failed = db_instance.session.query(Job).get(2)
+    assert (failed.status, failed.attempts) == ('pending', 1)
+    assert 'ValueError' in failed.last_error
+
+    # until their lease expires
+    db_instance.session.query(Job).update({'locked_until': datetime(2000, 1, 1),
+                                           'run_at': datetime(2000, 1, 1)})
+    db_instance.session.commit()
+    assert run_jobs('second', limit=10) == 3
+    assert sorted(_calls) == [1, 2, 2, 3]
+    assert [(j.id, j.status) for j in db_instance.session.query(Job)] == [(2, 'failed')]
+
+    # a job timing out is not run again while it can still be running
+    slow = enqueue('test_job', value=4, seconds=0.3)
+    db_instance.session.commit()
+    assert run_jobs('slow', timeout=0.05) == 1
+    assert (slow.status, slow.locked_by, slow.attempts) == ('running', 'slow', 1)
+    assert 'TimeoutError' in slow.last_error
+    assert run_jobs('second', limit=10) == 0
+    time.sleep(0.3)
+    assert _calls[-1] == 4
+    db_instance.session.delete(slow)
+    db_instance.session.commit()
+
+    # heavy work, as the statistics rebuild, runs in the worker
+    add_user(client, db_instance)
+    client.post('/add_runs', json={1: [_run(1, 10.0)]})
+    db_instance.session.query(RunStats).delete()
+    enqueue('rebuild_stats', user_ids=[1])
+    db_instance.session.commit()
+    assert run_jobs('worker') == 1
+    assert db_instance.session.query(RunStats).count() == 3
+
+
+#i created multiple functions just because i wanted to keep the json post requests seperate.
+
+def test_metrics(tmpdir):
+    with open(os.path.join(_HERE, '..', 'beepbeep', 'dataservice', 'settings.ini')) as f:
+        settings = f.read()
+    settings = settings.replace('/tmp/beepbeep.dataservice.db', str(tmpdir.join('metrics.db')))
+    settings = settings.replace('PROFILE_SAMPLE_RATE = 0', 'PROFILE_SAMPLE_RATE = 1')
+    settings = settings.replace('PROFILE_SLOW_SECONDS = 1', 'PROFILE_SLOW_SECONDS = 0')
+    settings = settings.replace('/tmp/beepbeep-profiles', str(tmpdir.join('profiles')))
+    tmpdir.join('settings.ini').write(settings)
+    app = create_app(str(tmpdir.join('settings.ini')))
+    db.init_app(app)
+    client = app.test_client()
+    for metric in metrics.HISTOGRAMS:
+        metric.clear()
+    with app.app_context():
+        db.create_all()
+        add_user(client, db)
+        assert client.get('/users/1').status_code == 200
+        db.get_engine(app).dispose()
+
+    res = client.get('/metrics')
+    assert res.status_code == 200
+    text = res.get_data(as_text=True)
+    assert ('beepbeep_request_duration_seconds_count{operation="getSingleUser",method="GET",'
+            'status="200"} 1') in text
+    assert 'beepbeep_request_sql_queries_count{operation="addUser"} 1' in text
+    # the user is read with one query, and its version checked again before it's cached
+    assert 'beepbeep_request_sql_queries_bucket{operation="getSingleUser",le="1"} 0' in text
+    assert 'beepbeep_request_sql_queries_bucket{operation="getSingleUser",le="2"} 1' in text
+    assert 'beepbeep_request_json_encode_seconds_count{operation="getSingleUser"} 1' in text
+    assert 'beepbeep_cache{cache="response",stat="misses"}' in text
+    assert 'beepbeep_http_pool{stat="size"}' in text
+    # the prefork workers are told apart
+    metrics.label_workers()
+    try:
+        text = client.get('/metrics').get_data(as_text=True)
+    finally:
+        metrics.label_workers(False)
+    assert 'beepbeep_http_pool{worker="%d",stat="size"}' % os.getpid() in text
+    # the slow requests are profiled
+    profiles = [name for name in os.listdir(str(tmpdir.join('profiles'))) if 'getSingleUser' in name]
+    assert sorted(os.path.splitext(name)[1] for name in profiles) == ['.prof', '.txt']
+
+
+def test_spec_cache(tmpdir):
+    spec = tmpdir.join('api.yaml')
+    spec.write('paths:\n  /users:\n    get:\n      operationId: getUsers\n')
+    cache_dir = str(tmpdir.join('cache'))
+    path = cached_spec(str(spec), cache_dir)
+    with open(path) as f:
+        assert json.load(f)['paths']['/users']['get']['operationId'] == 'getUsers'
+    assert os.listdir(cache_dir) == [os.path.basename(path)]
+
+    # unchanged, the spec is not parsed again
+    with mock.patch('beepbeep.dataservice.spec.compile_spec') as compile_spec:
+        os.utime(str(spec), ns=(0, 0))
+        assert cached_spec(str(spec), cache_dir) == path
+    assert not compile_spec.called
+
+    # a new content is found even when the mtime is restored
+    spec.write('paths:\n  /users:\n    post:\n      operationId: addPeople\n'
+               '      requestBody:\n        content:\n          application/json:\n'
+               '            schema:\n              $ref: "#/components/schemas/People"\n'
+               'components:\n  schemas:\n    People:\n      type: array\n      items:\n'
+               '        type: string\n')
+    os.utime(str(spec), ns=(0, 0))
+    assert cached_spec(str(spec), cache_dir) != path
+    assert len(os.listdir(cache_dir)) == 1
+
+    # the blueprint routes are built from the cached spec, and the bodies
+    # checked by the validators compiled with it
+    bp = CachedSwaggerBlueprint('test', __name__, swagger_spec=str(spec), cache_dir=cache_dir)
+    assert bp.ops['addPeople']['path'] == '/users'
+
+    @bp.operation('addPeople')
+    def add_people():
+        return {'added': len(request.get_json())}
+
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    client = app.test_client()
+    with mock.patch('jsonschema.validate') as validate:
+        assert client.post('/users', json=['Ann', 'Bob']).json == {'added': 2}
+        assert client.post('/users', json=['Ann', 1]).status_code == 400
+    assert not validate.called
+
+
+def test_request_body_validation(client, db_instance):
+    body = {'email': 'pinco@gmail.it', 'firstname': 'pinco', 'lastname': 'panco', 'age': 'two',
+            'weight': 1, 'max_hr': 2, 'rest_hr': 1, 'vo2max': 1}
+    # as flakon validating the body against the spec on every request
+    schema = dict(swagger.api.ops['addUser']['requestBody']['content']['application/json']['schema'],
+                  components=swagger.api.spec['components'])
+    with pytest.raises(jsonschema.ValidationError):
+        jsonschema.validate(body, schema)
+
+    response = client.post('/users', json=body)
+    assert response.status_code == 400
+    assert "'two' is not of type 'integer'" in response.json['message']
+    assert db_instance.session.query(User).count() == 0
+    assert client.post('/add_runs', json={'1': [{'strava_id': 'one'}]}).status_code == 400
+
+
+_BASELINE_SCHEMA = '''
+CREATE TABLE user (
+    id INTEGER NOT NULL, email VARCHAR(128) NOT NULL, firstname VARCHAR(128),
+    lastname VARCHAR(128), strava_token VARCHAR(128), age INTEGER, weight NUMERIC(4, 1),
+    max_hr INTEGER, rest_hr INTEGER, vo2max NUMERIC(4, 2), is_active BOOLEAN,
+    total_speed FLOAT, total_runs INTEGER,
+    report_periodicity VARCHAR(7), PRIMARY KEY (id));
+CREATE TABLE run (
+    id INTEGER NOT NULL, title VARCHAR(128), description VARCHAR(512), strava_id INTEGER,
+    distance FLOAT, start_date DATETIME, elapsed_time INTEGER, average_speed FLOAT,
+    average_heartrate FLOAT, total_elevation_gain FLOAT, runner_id INTEGER,
+    PRIMARY KEY (id), FOREIGN KEY(runner_id) REFERENCES user (id));
+INSERT INTO user VALUES (1, 'old@example.com', 'Old', 'User', NULL, 30, 70, 190, 50, 50, 1,
+                         60.0, 4, 'No');
+INSERT INTO run VALUES (1, 'Run', NULL, 7, 5000, '2018-03-03 10:00:00', 1500, 10.0, 150, 10, 1);
+INSERT INTO run VALUES (2, 'Run', NULL, 7, 5000, '2018-03-03 10:00:00', 1500, 30.0, 150, 10, 1);
+INSERT INTO run VALUES (3, 'Run', NULL, 8, 5000, '2018-03-04 10:00:00', 1500, 20.0, 150, 10, 1);
+INSERT INTO run VALUES (4, 'Run', NULL, NULL, 5000, '2018-03-05 10:00:00', 1500, 0.0, 150, 10, 1);
+'''
+
+
+def test_upgrade_database(tmpdir, caplog):
+    path = str(tmpdir.join('old.db'))
+    connection = sqlite3.connect(path)
+    connection.executescript(_BASELINE_SCHEMA)
+    connection.close()
+
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        upgrade_database()
+        # the oldest of the duplicated runs is kept, the ones without a strava id stay
+        assert [run.id for run in db.session.query(Run).order_by(Run.id)] == [1, 3, 4]
+        # the removed run is reported and in the change log
+        assert '2 (strava id 7)' in caplog.text
+        assert [(c.entity_id, c.op) for c in get_changes(0, 10)] == [(2, 'delete')]
+        user = db.session.query(User).get(1)
+        assert (user.total_runs, user.total_speed, user.revision) == (3, 30.0, 1)
+        indexes = {index['name']: index for index in inspect(db.engine).get_indexes('run')}
+        assert indexes['ix_run_strava_id']['unique']
+        assert 'ix_run_runner_start_date_id' in indexes
+        user_indexes = inspect(db.engine).get_indexes('user')
+        assert 'ix_user_is_active_id' in set(index['name'] for index in user_indexes)
+
+        # a second upgrade has nothing to do
+        upgrade_database()
+        assert db.session.query(Run).count() == 3
+        assert ingest_runs({1: [_run(7, 50.0), _run(9, 50.0)]}) == 1
+        db.get_engine(app).dispose()
+
+
+def test_rebuild_old_database(tmpdir):
+    path = str(tmpdir.join('old.db'))
+    connection = sqlite3.connect(path)
+    connection.executescript(_BASELINE_SCHEMA)
+    connection.close()
+    with open(os.path.join(_HERE, '..', 'beepbeep', 'dataservice', 'settings.ini')) as f:
+        settings = f.read().replace('/tmp/beepbeep.dataservice.db', path)
+    tmpdir.join('settings.ini').write(settings)
+
+    # the database is upgraded before the rebuild
+    rebuild.main(['--config-file', str(tmpdir.join('settings.ini'))])
+    connection = sqlite3.connect(path)
+    try:
+        periods = connection.execute('SELECT period, SUM(count) FROM run_stats GROUP BY period').fetchall()
+        revision, = connection.execute('SELECT revision FROM user').fetchone()
+    finally:
+        connection.close()
+    assert sorted(periods) == [('daily', 3), ('monthly', 3), ('weekly', 3)]
+    assert revision == 2